@@ -1,6 +1,10 @@
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
+import os
+import subprocess
+import threading
+
 from ansible.inventory import Inventory
 from ansible.parsing.dataloader import DataLoader
 from ansible.vars import VariableManager
@@ -13,14 +17,20 @@ class AnsibleInventory(object):
         'ansible_connection': 'ssh',
         'module_path': '/path/to/my/modules',
         'forks': 100,
+        'ansible_user': None,
+        'ansible_host': None,
+        'ansible_port': None,
+        'ansible_become': False,
         'ansible_remote_user': None,
         'ansible_ssh_private_key_file': None,
         'ansible_ssh_common_args': None,
         'ansible_ssh_extra_args': None,
+        'ansible_ssh_pipelining': False,
         'ansible_become_user': None,
         'ansible_become_method': None,
         'ansible_become_user': None,
-        'check': False
+        'check': False,
+        'timeout': 10
     }
 
     def __init__(self):
@@ -29,13 +39,35 @@ class AnsibleInventory(object):
         self.inventory = Inventory(
             loader=self.loader, variable_manager=self.variable_manager, host_list=settings.ANSIBLE_INVENTORY)
         self.hosts_data = self._serialize(self.inventory)
+        self.hosts_vars = {host["name"]: host["vars"]
+                           for host in self.hosts_data if not host["name"] == "all"}
         self.unique_hosts_data = {host[
             "name"]: host for host in self.hosts_data if not host["name"] == "all"}.values()
+        self._global_options = [host["vars"]
+                                for host in self.hosts_data if host["name"] == "all"]
+        self._hosts_choices = None
 
     @property
     def global_options(self):
         """Returns the global Inventory options(configs) from hosts"""
-        return [host["vars"] for host in self.hosts_data if host["name"] == "all"]
+        return self._global_options
+
+    def host_options(self, host_name=None, persist=None):
+        """Returns the default options updated with the global and the host options
+
+        With `persist` the options reuse one SSH connection per host, it
+        defaults to the ANSIBLE_SSH_PERSIST setting.
+        """
+        options = self.DEFAULT_OPTIONS.copy()
+        if self._global_options:
+            options.update(self._global_options[0])
+        if host_name is not None:
+            options.update(self.hosts_vars[host_name])
+        if persist is None:
+            persist = getattr(settings, 'ANSIBLE_SSH_PERSIST', False)
+        if persist:
+            options = ssh_persist_options(options)
+        return options
 
     @property
     def hosts_list(self):
@@ -48,12 +80,13 @@ class AnsibleInventory(object):
 
     @property
     def hosts_to_choices(self):
-        """Convert host names to choices """
-        host_choices = ()
-        host_choices += (' ', _("------")),
-        for host in self.unique_hosts_data:
-            host_choices += ((host["name"], _(host["name"],),),)
-        return host_choices
+        """Convert host names to choices, built once per inventory"""
+        if self._hosts_choices is None:
+            host_choices = [(' ', _("------"))]
+            for host in self.unique_hosts_data:
+                host_choices.append((host["name"], _(host["name"],)))
+            self._hosts_choices = tuple(host_choices)
+        return self._hosts_choices
 
     def _serialize(self, inventory):
         """Serialize data from Inventory file"""
@@ -67,3 +100,80 @@ class AnsibleInventory(object):
             elif group == 'all':
                 data.append(inventory.get_group('all').serialize())
         return data
+
+
+def ssh_control_path_dir():
+    """Returns the directory of the SSH ControlMaster sockets, creating it on first use"""
+    path = getattr(settings, 'ANSIBLE_SSH_CONTROL_PATH_DIR',
+                   os.path.join(settings.BASE_DIR, 'ssh_control'))
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    return path
+
+
+def ssh_persist_options(options):
+    """Returns a copy of the options that reuses one SSH connection per host
+
+    A ControlMaster socket is opened under the panel's control directory on
+    the first connection to a host and kept for ANSIBLE_SSH_CONTROL_PERSIST
+    seconds, so later plays skip the TCP and SSH handshakes. Pipelining runs
+    the modules over that connection without copying them to the host first.
+    The sockets are named with `%C`, the hash of the connection, so their
+    paths stay short whatever the host name. Any `ansible_ssh_common_args` of
+    the inventory are kept.
+    """
+    options = options.copy()
+    persist_args = "-o ControlMaster=auto -o ControlPersist={0}s -o ControlPath={1}".format(
+        getattr(settings, 'ANSIBLE_SSH_CONTROL_PERSIST', 600),
+        os.path.join(ssh_control_path_dir(), "%C"))
+    options['ansible_ssh_common_args'] = " ".join(
+        args for args in (options.get('ansible_ssh_common_args'), persist_args) if args)
+    options['ansible_ssh_pipelining'] = True
+    return options
+
+
+def close_ssh_connections():
+    """Close the persistent SSH connections of the panel
+
+    Returns the number of ControlMaster sockets that were closed.
+    """
+    path = ssh_control_path_dir()
+    closed = 0
+    with open(os.devnull, 'w') as devnull:
+        for name in os.listdir(path):
+            socket_path = os.path.join(path, name)
+            # The host name is ignored by ssh -O, the socket identifies the connection
+            if subprocess.call(["ssh", "-o", "ControlPath=" + socket_path, "-O", "exit", name],
+                               stdout=devnull, stderr=subprocess.STDOUT) == 0:
+                closed += 1
+    return closed
+
+
+_inventory_lock = threading.Lock()
+_inventory_cache = {}
+
+
+def _inventory_signature(path):
+    """Returns the (mtime, size) pair used to detect inventory changes"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def get_inventory():
+    """Returns the process-wide AnsibleInventory
+
+    The inventory is parsed once and shared between threads. It is reloaded
+    only when the mtime or the size of the inventory file changes, so callers
+    must treat the returned object as read-only.
+    """
+    path = settings.ANSIBLE_INVENTORY
+    signature = _inventory_signature(path)
+    with _inventory_lock:
+        cached = _inventory_cache.get(path)
+        if cached is None or cached[0] != signature:
+            cached = (signature, AnsibleInventory())
+            _inventory_cache[path] = cached
+        return cached[1]
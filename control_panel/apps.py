@@ -6,5 +6,5 @@ from django.apps import AppConfig
 class ControlPanelConfig(AppConfig):
     name = 'control_panel'
     def ready(self):
-        pass
+        import control_panel.signals
 
@@ -0,0 +1,65 @@
+from django.conf import settings
+
+from control_panel.models import Audit
+
+import threading
+import time
+
+
+class AuditSink(object):
+    """Buffers Audit logs in memory and writes them with a single bulk insert
+
+    The buffer is written once it holds `max_size` logs or its oldest log is
+    `max_age` seconds old, and whenever `flush` is called at the end of a
+    request or a background job.
+    """
+
+    def __init__(self, max_size=100, max_age=5):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._logs = []
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def log(self, log, status="", user=None):
+        """Buffer an Audit log, the timestamp is taken now
+
+        Logs longer than the log column are truncated, so that a single log
+        cannot make the bulk insert of the whole buffer fail.
+        """
+        max_length = Audit._meta.get_field('log').max_length
+        if len(log) > max_length:
+            log = log[:max_length - 3] + "..."
+        with self._lock:
+            self._logs.append(Audit(log=log, status=status, user=user))
+            if self._oldest is None:
+                self._oldest = time.time()
+            is_full = len(self._logs) >= self.max_size or \
+                time.time() - self._oldest >= self.max_age
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered Audit logs"""
+        with self._lock:
+            logs, self._logs = self._logs, []
+            self._oldest = None
+        if logs:
+            Audit.objects.bulk_create(logs)
+
+
+audit_sink = AuditSink(max_size=getattr(settings, 'AUDIT_BUFFER_SIZE', 100),
+                       max_age=getattr(settings, 'AUDIT_BUFFER_AGE', 5))
+
+
+class AuditFlushMiddleware(object):
+    """Writes the buffered Audit logs at the end of every request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            audit_sink.flush()
@@ -0,0 +1,300 @@
+from collections import deque
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from control_panel import deploy
+from control_panel.audit import audit_sink
+from control_panel.compiler import compile_rules
+from control_panel.mesh import build_full_mesh
+from control_panel.models import DeployJob, Host, InstanceType, Region, Rule, RuleGroup, WAN, ip_key
+
+import copy
+import gc
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Fixtures that the benchmark database is seeded from
+FIXTURES = ('Region.json', 'WAN.json', 'InstanceTypes.json', 'Superuser.json')
+
+
+class FakeResult(object):
+    """The TaskResult that the fake executor passes to the callbacks"""
+
+    def __init__(self, host, task, result):
+        self._host = host
+        self._task = task
+        self._result = result
+
+
+class FakeTask(object):
+    """The Task that the fake executor passes to the callbacks"""
+
+    def __init__(self, data):
+        self.action = data['action']['module']
+        self.args = data['action'].get('args') or {}
+
+    def get_name(self):
+        return self.action
+
+
+class FakePlay(object):
+    """Stands in for the Ansible Play, the fake executor reads the play source as is"""
+
+    def load(self, data, variable_manager=None, loader=None):
+        self.data = data
+        return self
+
+
+def fake_facts(host):
+    """Returns the Ansible facts that the setup module would report for a host"""
+    return {
+        'ansible_fqdn': host.get_name(),
+        'ansible_default_ipv4': {'address': host.vars.get('ansible_host', '127.0.0.1')},
+        'ansible_processor_cores': 4,
+        'ansible_memory_mb': {'real': {'total': 8192}},
+        'ansible_lsb': {'description': 'Ubuntu 16.04.2 LTS'},
+        'ansible_kernel': '4.4.0-78-generic',
+    }
+
+
+class FakeTaskQueueManager(object):
+    """An in-process TaskQueueManager that runs every play without connecting to the hosts
+
+    Every task takes `latency` seconds per batch of `forks` hosts, as if the
+    hosts were handled in parallel by the forks, and then reports an ok result
+    for each host to the stdout callback. The results have the shape of the
+    ones of the real modules. Like the real executor, exceptions raised by the
+    callback are caught and counted instead of aborting the play.
+    """
+
+    RUN_OK = 0
+    RUN_ERROR = 1
+    RUN_FAILED_HOSTS = 2
+    RUN_UNREACHABLE_HOSTS = 4
+
+    latency = 0.0
+    plays = 0
+    callback_errors = 0
+
+    def __init__(self, inventory, variable_manager, loader, options, passwords, stdout_callback=None):
+        self._inventory = inventory
+        self._options = options
+        self._stdout_callback = stdout_callback
+
+    def _send_callback(self, method_name, *args):
+        try:
+            getattr(self._stdout_callback, method_name)(*args)
+        except Exception:
+            FakeTaskQueueManager.callback_errors += 1
+
+    def _module_result(self, host, module):
+        if module == 'setup':
+            return {'ansible_facts': fake_facts(host), 'changed': False}
+        if module in ('shell', 'command'):
+            return {'rc': 0, 'changed': True, 'stdout': '', 'stderr': '',
+                    'stdout_lines': [], 'stderr_lines': []}
+        return {'changed': True}
+
+    def run(self, play):
+        FakeTaskQueueManager.plays += 1
+        hosts = [self._inventory.get_host(name) for name in play.data['hosts']]
+        if play.data.get('gather_facts') == 'yes':
+            tasks = [dict(action=dict(module='setup'))]
+        else:
+            tasks = []
+        tasks.extend(play.data.get('tasks') or [])
+        forks = max(getattr(self._options, 'forks', 1) or 1, 1)
+        for task in map(FakeTask, tasks):
+            self._send_callback('v2_playbook_on_task_start', task, False)
+            time.sleep(self.latency * math.ceil(len(hosts) / float(forks)))
+            for host in hosts:
+                self._send_callback('v2_runner_on_ok', FakeResult(
+                    host, task, self._module_result(host, task.action)))
+        return self.RUN_OK
+
+    def cleanup(self):
+        pass
+
+
+@contextmanager
+def fake_ansible(latency=0.0):
+    """Run the plays of AnsibleDeploy with the FakeTaskQueueManager"""
+    original = deploy.TaskQueueManager, deploy.Play
+    FakeTaskQueueManager.latency = latency
+    FakeTaskQueueManager.plays = 0
+    FakeTaskQueueManager.callback_errors = 0
+    deploy.TaskQueueManager, deploy.Play = FakeTaskQueueManager, FakePlay
+    try:
+        yield FakeTaskQueueManager
+    finally:
+        deploy.TaskQueueManager, deploy.Play = original
+
+
+def _host_address(i):
+    return "10.{0}.{1}.{2}".format(i // 62500 % 256, i // 250 % 250, i % 250 + 1)
+
+
+def seed(n_hosts, n_regions):
+    """Seed the hosts, the regions and a full-mesh RuleGroup per region
+
+    The regions, WANs, instance types and the superuser come from the
+    fixtures. Regions beyond the ones of the fixtures copy the fixture
+    regions, and every pair of regions without a WAN gets a copy of a fixture
+    WAN. Returns the rule groups.
+    """
+    call_command('loaddata', *FIXTURES, verbosity=0)
+    regions = list(Region.objects.order_by('id'))
+    templates = list(regions)
+    for i in range(len(regions), n_regions):
+        region = copy.copy(templates[i % len(templates)])
+        region.pk = None
+        region.name = "{0} {1}".format(region.name, i)
+        region.save()
+        regions.append(region)
+    regions = regions[:max(n_regions, 1)]
+    wans = set(WAN.objects.values_list('name', flat=True))
+    wan = WAN.objects.order_by('id').first()
+    new_wans = []
+    for src in regions:
+        for dst in regions:
+            name = "{0}_{1}".format(src.slug, dst.slug)
+            if src.id != dst.id and name not in wans and \
+                    "{0}_{1}".format(dst.slug, src.slug) not in wans:
+                new_wans.append(WAN(name=name, bandwidth=wan.bandwidth, bw_rate=wan.bw_rate,
+                                    latency=wan.latency, latency_time_unit=wan.latency_time_unit,
+                                    packet_loss=wan.packet_loss,
+                                    packet_corruption_rate=wan.packet_corruption_rate))
+                wans.add(name)
+    WAN.objects.bulk_create(new_wans)
+
+    # The instance type fixtures leave out the latency unit that the rules need
+    InstanceType.objects.filter(latency_time_unit__isnull=True).update(latency_time_unit=1)
+    instance_types = list(InstanceType.objects.order_by('id'))
+    Host.objects.bulk_create([
+        Host(name="bench-host-{0:04d}".format(i), region=regions[i % len(regions)],
+             instance_type=instance_types[i % len(instance_types)], interface="eth0",
+             ip_address=_host_address(i), ip_key=ip_key(_host_address(i)), is_active=True)
+        for i in range(n_hosts)])
+
+    rule_groups = []
+    for region in regions:
+        rule_group = RuleGroup.objects.create(name="bench-mesh-{0}".format(region.slug))
+        build_full_mesh(rule_group, list(Host.objects.filter(
+            region=region).values_list('id', flat=True)))
+        rule_groups.append(rule_group)
+    return rule_groups
+
+
+def write_inventory(path):
+    """Write an Ansible inventory with every seeded host"""
+    with open(path, 'w') as inventory:
+        inventory.write("[all:vars]\nansible_connection=ssh\n\n[bench]\n")
+        for name, address in Host.objects.order_by('name').values_list('name', 'ip_address'):
+            inventory.write("{0} ansible_host={1} ansible_port=22\n".format(name, address))
+
+
+@contextmanager
+def measure(report, name):
+    """Record the wall time, the number of queries and the peak memory of a block"""
+    gc.collect()
+    # Keep every query of the block, the default log only keeps the last 9000
+    queries_log, connection.queries_log = connection.queries_log, deque()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    started = time.time()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            yield
+            audit_sink.flush()
+    finally:
+        connection.queries_log = queries_log
+    report[name] = {
+        "seconds": round(time.time() - started, 4),
+        "queries": len(queries.captured_queries),
+        "peak_memory_kb": None,
+    }
+    if tracemalloc is not None:
+        report[name]["peak_memory_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+
+
+def measure_startup(repeat=5):
+    """Returns the median seconds that a new process takes to set up Django
+
+    This is the start-up cost that every manage.py call and worker boot pays
+    before doing any work.
+    """
+    script = "import time; started = time.time(); import django; django.setup(); print(time.time() - started)"
+    durations = sorted(
+        float(subprocess.check_output([sys.executable, "-c", script], cwd=settings.BASE_DIR))
+        for _ in range(repeat))
+    return round(durations[len(durations) // 2], 4)
+
+
+def run_size(n_hosts, n_regions, latency=0.0):
+    """Seed a database of the given size and measure compile, deploy, delete and gather
+
+    Returns the report of the size as a dict. The database is flushed first,
+    so it must be a throw-away one.
+    """
+    from control_panel.jobs.hourly.gather import Job as GatherJob
+    from control_panel.tasks import delete_rules, run_deploy_job
+
+    call_command('flush', interactive=False, verbosity=0)
+    report = {"hosts": n_hosts, "regions": n_regions}
+    with measure(report, "seed"):
+        rule_groups = seed(n_hosts, n_regions)
+    report["rules"] = Rule.objects.count()
+    user = User.objects.filter(is_superuser=True).first()
+
+    work_dir = tempfile.mkdtemp(prefix="tc-panel-benchmark-")
+    overridden = dict((name, getattr(settings, name)) for name in ('ANSIBLE_INVENTORY', 'FACT_CACHE_DIR'))
+    settings.ANSIBLE_INVENTORY = os.path.join(work_dir, "hosts")
+    settings.FACT_CACHE_DIR = os.path.join(work_dir, "fact_cache")
+    write_inventory(settings.ANSIBLE_INVENTORY)
+    try:
+        with fake_ansible(latency) as executor:
+            with measure(report, "compile"):
+                compile_rules(Rule.objects.filter(rulegroup__in=rule_groups))
+
+            job = DeployJob.objects.create(user=user)
+            job.rule_groups.add(*rule_groups)
+            with measure(report, "deploy"):
+                run_deploy_job(job.id)
+            report["deploy"]["plays"] = executor.plays
+
+            host = Host.objects.filter(rule__isnull=False).order_by('name').first()
+            rule_ids = list(Rule.objects.filter(host=host).values_list('id', flat=True))
+            executor.plays = 0
+            with measure(report, "delete"):
+                job = DeployJob.objects.create(user=user, is_undeploy=True,
+                                               teardown=json.dumps(delete_rules(rule_ids)))
+                run_deploy_job(job.id)
+            report["delete"].update(rules=len(rule_ids), plays=executor.plays)
+
+            executor.plays = 0
+            with measure(report, "gather"):
+                GatherJob().execute()
+            report["gather"]["plays"] = executor.plays
+            report["callback_errors"] = executor.callback_errors
+    finally:
+        for name, value in overridden.items():
+            setattr(settings, name, value)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
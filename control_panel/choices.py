@@ -1,9 +1,5 @@
 from django.utils.translation import ugettext_lazy as _
 
-from control_panel.ansible_helpers import AnsibleInventory
-
-
-HOSTS_CHOICES = AnsibleInventory().hosts_to_choices
 
 RATE_CHOICES = (
     (1, _('Kbps')),
@@ -25,3 +21,9 @@ ACTION_CHOICES = (
     (1, _('Delete')),
 )
 
+JOB_STATUS_CHOICES = (
+    (1, _('Pending')),
+    (2, _('Running')),
+    (3, _('Finished')),
+    (4, _('Failed')),
+)
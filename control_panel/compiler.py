@@ -0,0 +1,156 @@
+from collections import defaultdict, OrderedDict
+from django.db.models import prefetch_related_objects
+from django.db.models.query import QuerySet
+
+from control_panel.choices import RATE_CHOICES, TIME_CHOICES
+from control_panel.models import Host
+from control_panel.paths import get_path_costs
+
+import ipaddr
+import operator
+
+
+RULE_RELATIONS = ('host__region', 'host__instance_type', 'target_region',
+                  'target_host__region', 'target_host__instance_type')
+
+
+class RuleCompiler(object):
+    """Compiles Rules to tcconfig commands
+
+    The hosts, regions and instance types of the rules are loaded up front
+    and the region to region characteristics come from a PathCostMatrix
+    built once per compiler, so compiling any number of rules costs a fixed
+    number of queries.
+    """
+
+    def __init__(self, rules):
+        if isinstance(rules, QuerySet):
+            rules = list(rules.select_related(*RULE_RELATIONS))
+        else:
+            rules = list(rules)
+            prefetch_related_objects(rules, *RULE_RELATIONS)
+        self.rules = rules
+        self.path_costs = get_path_costs()
+        self._region_hosts = None
+
+    @property
+    def region_hosts(self):
+        """The hosts of the regions targeted by rules without a target host"""
+        if self._region_hosts is None:
+            self._region_hosts = defaultdict(list)
+            region_ids = set(rule.target_region_id for rule in self.rules
+                             if rule.target_host_id is None and rule.target_region_id)
+            if region_ids:
+                hosts = Host.objects.filter(region_id__in=region_ids).select_related(
+                    'region', 'instance_type')
+                for host in hosts:
+                    self._region_hosts[host.region_id].append(host)
+        return self._region_hosts
+
+    def target_hosts(self, rule):
+        """Returns the hosts that a rule shapes the traffic to"""
+        if rule.target_host_id:
+            return [rule.target_host]
+        return [host for host in self.region_hosts[rule.target_region_id]
+                if host.id != rule.host_id]
+
+    def tcset_settings(self, rule):
+        """Returns the tcset arguments of a rule, one dict per command"""
+        tcset_commands = []
+        rate_choices = dict(RATE_CHOICES)
+        time_choices = dict(TIME_CHOICES)
+        for target_host in self.target_hosts(rule):
+            path = self.path_costs.path(rule.host.region_id, target_host.region_id)
+            bandwidths = [(rule.bandwidth, rule.bw_rate),
+                          (target_host.instance_type.bandwidth,
+                           target_host.instance_type.bw_rate),
+                          (path.bandwidth, path.bw_rate)]
+            bandwidths = [tp for tp in bandwidths if all(tp)]
+            min_bandwidth, min_bandwidth_rate = min(
+                bandwidths, key=operator.itemgetter(1, 0))
+            latency = rule.latency + rule.host.instance_type.latency + path.latency
+            packet_loss = (rule.packet_loss or 0) + \
+                rule.host.instance_type.packet_loss + path.packet_loss
+            packet_corruption_rate = (rule.packet_corruption_rate or 0) + \
+                rule.host.instance_type.packet_corruption_rate + path.packet_corruption_rate
+
+            tcset = OrderedDict()
+            tcset['rate'] = str(int(min_bandwidth)) + \
+                str(rate_choices[min_bandwidth_rate])
+            tcset['delay'] = str(int(latency)) + \
+                str(time_choices[rule.latency_time_unit])
+            tcset['device'] = rule.interface
+            tcset['loss'] = int(packet_loss)
+            tcset['corrupt'] = packet_corruption_rate
+            tcset['port'] = rule.port_number
+            tcset['src-port'] = rule.src_port_number
+            tcset['dst-network'] = rule.target_ip_address or target_host.ip_address
+            tcset['direction'] = rule.traffic_type
+
+            if not rule.traffic_type:
+                tcset['direction'] = 'outgoing'
+                tcset_commands.append(tcset)
+                shallow_copy_tcset = tcset.copy()
+                shallow_copy_tcset['direction'] = 'incoming'
+                tcset_commands.append(shallow_copy_tcset)
+        return tcset_commands
+
+    def command(self, rule, deactivate=False):
+        """Returns the tcconfig command of a rule"""
+        if deactivate:
+            return "tcdel --device " + rule.interface + " --all"
+        final_command = []
+        for cmd in self.tcset_settings(rule):
+            final_command.append(format_tcset(cmd))
+        return " ".join(final_command)
+
+    def commands(self, deactivate=False):
+        """Returns the tcconfig commands of all the rules keyed by rule id"""
+        return OrderedDict((rule.id, self.command(rule, deactivate=deactivate))
+                           for rule in self.rules)
+
+
+def aggregate_tcsets(tcsets):
+    """Merge the tcset arguments that only differ in their destination network
+
+    The destinations of every group of otherwise identical arguments are
+    collapsed to the smallest list of networks that covers exactly the same
+    addresses, so a source host needs one filter per distinct shaping profile
+    and network block instead of one per destination host.
+    """
+    groups = OrderedDict()
+    for tcset in tcsets:
+        if not tcset.get('dst-network'):
+            groups[id(tcset)] = (tcset, None)
+            continue
+        network = ipaddr.IPNetwork(tcset['dst-network'])
+        key = (network.version,) + tuple((k, v) for k, v in tcset.items() if k != 'dst-network')
+        groups.setdefault(key, (tcset, []))[1].append(network)
+
+    aggregated = []
+    for tcset, networks in groups.values():
+        if networks is None:
+            aggregated.append(tcset)
+            continue
+        for network in ipaddr.collapse_address_list(networks):
+            aggregated_tcset = tcset.copy()
+            if network.prefixlen == network.max_prefixlen:
+                aggregated_tcset['dst-network'] = str(network.ip)
+            else:
+                aggregated_tcset['dst-network'] = str(network)
+            aggregated.append(aggregated_tcset)
+    return aggregated
+
+
+def format_tcset(tcset):
+    """Convert tcset arguments to a tcset command"""
+    construct_cmd = []
+    for key, value in tcset.items():
+        if value:
+            construct_cmd.append("--" + key + " " + str(value))
+    return "tcset " + " ".join(construct_cmd) + " --change;"
+
+
+def compile_rules(rules, deactivate=False):
+    """Compile a queryset or a list of Rules to tcconfig commands keyed by rule id"""
+    return RuleCompiler(rules).commands(deactivate=deactivate)
@@ -1,8 +1,8 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from django.conf import settings
-from django.contrib.auth.models import User
 
-from control_panel.models import InventoryGroup, Host, Audit
+from control_panel.audit import audit_sink
+from control_panel.facts import FactCache, host_facts, save_host_facts
 
 from ansible.executor.task_queue_manager import TaskQueueManager
 from ansible.inventory import Inventory
@@ -11,45 +11,127 @@ from ansible.playbook.play import Play
 from ansible.plugins.callback import CallbackBase
 from ansible.vars import VariableManager
 
-from notifications.signals import notify
+import threading
+import time
 
-import datetime
+
+# Ansible's Python API keeps global state, a process runs one play at a time
+_play_lock = threading.Lock()
+
+TaskResult = namedtuple('TaskResult', ['task', 'status', 'rc', 'duration', 'stdout', 'stderr'])
+
+
+class DeployResult(object):
+    """The outcome of a play for every host and every task
+
+    `tasks` maps every host name to the TaskResults that it reported, in
+    order. `exit_code` is the code that the TaskQueueManager returned.
+    """
+
+    def __init__(self, hosts=()):
+        self.tasks = OrderedDict((host, []) for host in hosts)
+        self.exit_code = None
+
+    def add(self, host, task_result):
+        self.tasks.setdefault(host, []).append(task_result)
+
+    def host_status(self, host):
+        """Returns the worst TaskQueueManager status code of a host
+
+        Hosts that never reported back are treated as failed.
+        """
+        results = self.tasks.get(host)
+        if not results:
+            return TaskQueueManager.RUN_FAILED_HOSTS
+        return max(task_result.status for task_result in results)
+
+    @property
+    def status(self):
+        """A dict that maps every host name to its TaskQueueManager status code"""
+        return dict((host, self.host_status(host)) for host in self.tasks)
+
+    @property
+    def failed(self):
+        """The names of the hosts that did not run all their tasks successfully"""
+        return [host for host in self.tasks if self.host_status(host) != TaskQueueManager.RUN_OK]
+
+    def stdout(self, host):
+        """Returns the output of the last task of a host that wrote to stdout"""
+        for task_result in reversed(self.tasks.get(host, [])):
+            if task_result.stdout is not None:
+                return task_result.stdout
+        return None
+
+    def stderr(self, host):
+        """Returns the error output of all the tasks of a host"""
+        return "\n".join(task_result.stderr for task_result in self.tasks.get(host, [])
+                         if task_result.stderr)
+
+    def to_dict(self):
+        """Returns the results as a JSON serializable dict keyed by host name"""
+        return dict((host, [task_result._asdict() for task_result in results])
+                    for host, results in self.tasks.items())
 
 
 class ResultCallback(CallbackBase):
-    """A callback plugin used for managing the results as they come in"""
+    """A callback plugin that collects the results of every host as they come in"""
+
+    # Number of buffered host facts that triggers a write to the database
+    FLUSH_SIZE = 500
+
+    def __init__(self, *args, **kwargs):
+        self.progress = kwargs.pop('progress', None)
+        hosts = kwargs.pop('hosts', ())
+        super(ResultCallback, self).__init__(*args, **kwargs)
+        self.results = DeployResult(hosts)
+        self.facts = []
+        self.fact_cache = FactCache()
+        self._task_started = time.time()
+
+    def flush(self):
+        """Write the buffered host facts to the database"""
+        facts, self.facts = self.facts, []
+        if facts:
+            save_host_facts(facts)
+
+    def _add_result(self, result, status):
+        """Record the result of a task on a host"""
+        name = result._host.get_name()
+        results = result._result
+        previous = self.results.host_status(name) if self.results.tasks.get(name) else None
+        stderr = results.get('stderr') or ""
+        if status != TaskQueueManager.RUN_OK and not stderr:
+            stderr = results.get('msg') or ""
+        self.results.add(name, TaskResult(
+            task=result._task.get_name(), status=status, rc=results.get('rc'),
+            duration=round(time.time() - self._task_started, 3),
+            stdout=results.get('stdout'), stderr=stderr))
+        current = self.results.host_status(name)
+        if self.progress is not None and current != previous:
+            self.progress(name, current)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._task_started = time.time()
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        if ignore_errors:
+            self._add_result(result, TaskQueueManager.RUN_OK)
+        else:
+            self._add_result(result, TaskQueueManager.RUN_FAILED_HOSTS)
+
+    def v2_runner_on_unreachable(self, result):
+        self._add_result(result, TaskQueueManager.RUN_UNREACHABLE_HOSTS)
 
     def v2_runner_on_ok(self, result, **kwargs):
-        """This method stores the result in an instance attribute for retrieval later"""
-        host = result._host
+        self._add_result(result, TaskQueueManager.RUN_OK)
         results = result._result
         if 'ansible_facts' in results:
-            host_entry, created = Host.objects.update_or_create(name=results['ansible_facts']['ansible_fqdn'],
-                                                                defaults={
-                'ip_address': results['ansible_facts']['ansible_default_ipv4']['address'],
-                'cpu': results['ansible_facts']['ansible_processor_cores'],
-                'memory': str(results['ansible_facts']['ansible_memory_mb']['real']['total']) + 'MB',
-                'distribution': results['ansible_facts']['ansible_lsb']['description'],
-                'kernel': results['ansible_facts']['ansible_kernel'],
-                'region': None,
-                'is_active': True})
-
-            for group in host.groups:
-                group_entry, created = InventoryGroup.objects.update_or_create(
-                    name=group.name)
-                host_entry.inventory_groups.add(group_entry)
-
-        # Checks if the command returned error
-        if results['stderr_lines']:
-            # Send notifications to all the superusers
-            superusers = User.objects.filter(is_superuser=True)
-            for superuser in superusers:
-                recipient = User.objects.get(username=superuser)
-            message = "rules_failed"
-            notify.send(recipient, recipient=recipient,
-                        description="Host {0} - Output: {1}".format(
-                            host, results['stderr_lines']),
-                        verb=message)
+            host = result._host
+            self.fact_cache.set(host.get_name(), results['ansible_facts'])
+            self.facts.append(host_facts(
+                results['ansible_facts'], [group.name for group in host.groups]))
+            if len(self.facts) >= self.FLUSH_SIZE:
+                self.flush()
 
 
 class AnsibleDeploy(object):
@@ -57,7 +139,7 @@ class AnsibleDeploy(object):
 
     def __init__(self, options, stdout_callback='default', vault_pass='secret'):
         Options = namedtuple('Options', ['verbosity', 'connection', 'module_path', 'forks', 'host', 'remote_port', 'remote_user',
-                                         'private_key_file', 'ssh_common_args', 'ssh_extra_args', 'become', 'become_method', 'become_user', 'check'])
+                                         'private_key_file', 'ssh_common_args', 'ssh_extra_args', 'become', 'become_method', 'become_user', 'check', 'timeout'])
         self.options = Options(connection=options["ansible_connection"],
                                module_path=options["module_path"],
                                forks=options["forks"],
@@ -74,54 +156,158 @@ class AnsibleDeploy(object):
                                become_method=options["ansible_become_method"],
                                become_user=options["ansible_become_user"],
                                verbosity=1,
-                               check=options["check"])
+                               check=options["check"],
+                               timeout=options.get("timeout", 10))
         self.stdout_callback = stdout_callback
         self.vault_pass = vault_pass
         self.variable_manager = VariableManager()
         self.loader = DataLoader()
         self.passwords = dict(vault_pass=self.vault_pass)
+        # Pipelining has no command line option, it is set through its
+        # connection variable
+        self.extra_vars = {}
+        if options.get("ansible_ssh_pipelining"):
+            self.extra_vars["ansible_ssh_pipelining"] = True
 
-    def _log_deployment(self, cmd, host):
-        """Log the deployment events"""
-        timestamp = str(datetime.datetime.now())
-        log_command = Audit(timestamp=timestamp,
-                            log="Deploying %s to %s" % (cmd, host))
-        return log_command.save()
-
-    def deploy(self, cmd, destination_host, facts='no'):
-        """Deploy commands via Ansible"""
+    def _load_inventory(self):
+        """Load the inventory that the next play runs against"""
         self.inventory = Inventory(
             loader=self.loader, variable_manager=self.variable_manager, host_list=settings.ANSIBLE_INVENTORY)
         self.variable_manager.set_inventory(self.inventory)
-        results_callback = ResultCallback()
-        tasks = [dict(action=dict(module='shell', args=dict(_raw_params=cmd)), register='shell_out'),
-                 dict(action=dict(module='debug', args=dict(msg='{{shell_out.stdout}}')))]
-        print(cmd)
-        if not cmd:
-            tasks = None
+        self.variable_manager.extra_vars = self.extra_vars
+
+    def _log_deployment(self, cmd, host):
+        """Log the deployment events
+
+        The commands of a host can run to many KB for a mesh, so only the
+        number of tc commands is logged.
+        """
+        count = cmd.count("tcset ") + cmd.count("tcdel ")
+        if count:
+            cmd = "{0} tc commands".format(count)
+        audit_sink.log("Deploying %s to %s" % (cmd, host))
+
+    def _run(self, play_source, results_callback):
+        """Run a play against the loaded inventory and return its DeployResult"""
+        with _play_lock:
+            play = Play().load(play_source, variable_manager=self.variable_manager, loader=self.loader)
+            tqm = None
+            try:
+                tqm = TaskQueueManager(
+                    inventory=self.inventory,
+                    variable_manager=self.variable_manager,
+                    loader=self.loader,
+                    options=self.options,
+                    passwords=self.passwords,
+                    stdout_callback=results_callback,
+                )
+                results_callback.results.exit_code = tqm.run(play)
+            finally:
+                if tqm is not None:
+                    tqm.cleanup()
+                results_callback.flush()
+        return results_callback.results
+
+    def _set_commands(self, commands):
+        """Set the command of every host as its `tc_command` variable"""
+        for destination_host, cmd in commands.items():
+            self.variable_manager.set_host_variable(
+                self.inventory.get_host(destination_host), 'tc_command', cmd)
+
+    def _use_cached_facts(self, hosts):
+        """Set the fresh cached facts of the hosts
+
+        Returns True if every host had fresh facts, so that the setup module
+        can be skipped.
+        """
+        fact_cache = FactCache()
+        has_facts = True
+        for host in hosts:
+            cached_facts = fact_cache.get(host) if fact_cache.is_fresh(host) else None
+            if cached_facts:
+                self.variable_manager.set_host_facts(self.inventory.get_host(host), cached_facts)
+            else:
+                has_facts = False
+        return has_facts
+
+    def deploy_batch(self, commands, facts='no', progress=None):
+        """Deploy a command per host in a single play
+
+        `commands` maps host names to the command that should run on each
+        host. All the hosts run within the same play, so they are handled in
+        parallel up to the configured number of forks. With `facts` set to
+        "yes" the facts are gathered, unless every host has fresh cached facts.
+        `progress` is called with the host name and its status code whenever
+        the status of a host changes. Returns a DeployResult.
+        """
+        commands = dict((host, cmd) for host, cmd in commands.items() if cmd)
+        if not commands:
+            return DeployResult()
+        self._load_inventory()
+        results_callback = ResultCallback(progress=progress, hosts=sorted(commands))
+        self._set_commands(commands)
+        for destination_host, cmd in commands.items():
+            self._log_deployment(cmd, destination_host)
+        if facts == 'yes' and self._use_cached_facts(commands):
+            facts = 'no'
 
         play_source = dict(
-            name="Deploy Rules @ {0}".format(destination_host),
+            name="Deploy Rules @ {0} hosts".format(len(commands)),
             gather_facts=facts,
-            hosts=[destination_host],
-            tasks=tasks,)
-        play = Play().load(play_source, variable_manager=self.variable_manager, loader=self.loader)
-
-        self._log_deployment(cmd, destination_host)
-
-        tqm = None
-        try:
-            tqm = TaskQueueManager(
-                inventory=self.inventory,
-                variable_manager=self.variable_manager,
-                loader=self.loader,
-                options=self.options,
-                passwords=self.passwords,
-                #stdout_callback="debug",
-                stdout_callback=results_callback,
-            )
-            result = tqm.run(play)
-        finally:
-            if tqm is not None:
-                tqm.cleanup()
-        return result
+            hosts=sorted(commands),
+            tasks=[dict(action=dict(module='shell', args=dict(_raw_params='{{ tc_command }}')))],)
+        return self._run(play_source, results_callback)
+
+    def show_batch(self, commands):
+        """Run a read-only command per host in a single play and collect its output
+
+        `commands` maps host names to the command that should run on each
+        host. Nothing is logged as a deployment. Returns a DeployResult.
+        """
+        if not commands:
+            return DeployResult()
+        self._load_inventory()
+        results_callback = ResultCallback(hosts=sorted(commands))
+        self._set_commands(commands)
+        play_source = dict(
+            name="Show Rules @ {0} hosts".format(len(commands)),
+            gather_facts='no',
+            hosts=sorted(commands),
+            tasks=[dict(action=dict(module='shell', args=dict(_raw_params='{{ tc_command }}')))],)
+        return self._run(play_source, results_callback)
+
+    def copy_batch(self, hosts, content, dest):
+        """Copy the same content to a file on every host in a single play
+
+        The copy module compares checksums, so hosts that already have the
+        content are left untouched. Returns a DeployResult.
+        """
+        self._load_inventory()
+        results_callback = ResultCallback(hosts=hosts)
+        self._log_deployment(dest, "{0} hosts".format(len(hosts)))
+        play_source = dict(
+            name="Copy {0} @ {1} hosts".format(dest, len(hosts)),
+            gather_facts='no',
+            hosts=list(hosts),
+            tasks=[dict(action=dict(module='copy', args=dict(content=content, dest=dest)))],)
+        return self._run(play_source, results_callback)
+
+    def gather_facts(self, hosts, timeout=None):
+        """Gather the facts of the hosts in a single play
+
+        `timeout` bounds the fact gathering of each host in seconds. Returns a
+        DeployResult.
+        """
+        self._load_inventory()
+        results_callback = ResultCallback(hosts=hosts)
+        setup_args = dict(gather_timeout=timeout) if timeout else dict()
+        play_source = dict(
+            name="Gather Facts @ {0} hosts".format(len(hosts)),
+            gather_facts='no',
+            hosts=list(hosts),
+            tasks=[dict(action=dict(module='setup', args=setup_args))],)
+        return self._run(play_source, results_callback)
+
+    def deploy(self, cmd, destination_host, facts='no'):
+        """Deploy a command to a host, returns a DeployResult"""
+        return self.deploy_batch({destination_host: cmd}, facts=facts)
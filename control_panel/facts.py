@@ -0,0 +1,131 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Value, When
+
+from control_panel.models import Host, InventoryGroup, ip_key
+from control_panel.overview import invalidate_overview
+
+import json
+import os
+import tempfile
+import time
+
+
+HOST_FACT_FIELDS = ('ip_address', 'ip_key', 'cpu', 'memory', 'distribution', 'kernel', 'is_active')
+
+UPDATE_BATCH_SIZE = 50
+
+
+def host_facts(facts, groups):
+    """Convert the Ansible facts of a host to Host fields"""
+    return {
+        'name': facts['ansible_fqdn'],
+        'ip_address': facts['ansible_default_ipv4']['address'],
+        'ip_key': ip_key(facts['ansible_default_ipv4']['address']),
+        'cpu': str(facts['ansible_processor_cores']),
+        'memory': str(facts['ansible_memory_mb']['real']['total']) + 'MB',
+        'distribution': facts['ansible_lsb']['description'],
+        'kernel': facts['ansible_kernel'],
+        'is_active': True,
+        'groups': list(groups),
+    }
+
+
+def _bulk_update(hosts, fields):
+    """Update the fields of the hosts with one UPDATE per batch"""
+    for i in range(0, len(hosts), UPDATE_BATCH_SIZE):
+        batch = hosts[i:i + UPDATE_BATCH_SIZE]
+        values = {}
+        for field in fields:
+            values[field] = Case(
+                *[When(id=host.id, then=Value(getattr(host, field))) for host in batch],
+                output_field=Host._meta.get_field(field))
+        Host.objects.filter(id__in=[host.id for host in batch]).update(**values)
+
+
+@transaction.atomic
+def save_host_facts(entries):
+    """Insert or update the hosts of the fact entries in bulk
+
+    Only the hosts whose facts changed are updated. The inventory groups that
+    do not exist yet are created and the missing host to group links are
+    added, each with a single query.
+    """
+    entries = dict((entry['name'], entry) for entry in entries)
+    if not entries:
+        return
+    hosts = dict((host.name, host) for host in Host.objects.filter(name__in=list(entries)))
+
+    changed = []
+    for name, host in hosts.items():
+        if any(getattr(host, field) != entries[name][field] for field in HOST_FACT_FIELDS):
+            for field in HOST_FACT_FIELDS:
+                setattr(host, field, entries[name][field])
+            changed.append(host)
+    _bulk_update(changed, HOST_FACT_FIELDS)
+
+    new_hosts = [name for name in entries if name not in hosts]
+    if new_hosts:
+        Host.objects.bulk_create([
+            Host(name=name, region=None, **dict((field, entries[name][field]) for field in HOST_FACT_FIELDS))
+            for name in new_hosts])
+        hosts.update((host.name, host) for host in Host.objects.filter(name__in=new_hosts))
+
+    group_names = set(group for entry in entries.values() for group in entry['groups'])
+    groups = dict(InventoryGroup.objects.filter(
+        name__in=list(group_names)).values_list('name', 'id'))
+    missing_groups = group_names - set(groups)
+    if missing_groups:
+        InventoryGroup.objects.bulk_create([InventoryGroup(name=name) for name in missing_groups])
+        groups.update(InventoryGroup.objects.filter(
+            name__in=list(missing_groups)).values_list('name', 'id'))
+
+    Membership = Host.inventory_groups.through
+    links = set(Membership.objects.filter(
+        host_id__in=[host.id for host in hosts.values()]).values_list('host_id', 'inventorygroup_id'))
+    Membership.objects.bulk_create([
+        Membership(host_id=hosts[name].id, inventorygroup_id=groups[group])
+        for name, entry in entries.items() for group in set(entry['groups'])
+        if (hosts[name].id, groups[group]) not in links])
+    if changed or new_hosts:
+        invalidate_overview()
+
+
+class FactCache(object):
+    """The Ansible facts of the hosts, stored as one JSON file per host
+
+    The facts of a host are fresh for FACT_CACHE_TTL seconds after they were
+    written. Fresh facts make the setup module redundant for that host.
+    """
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path or getattr(settings, 'FACT_CACHE_DIR',
+                                    os.path.join(settings.BASE_DIR, 'fact_cache'))
+        self.ttl = ttl if ttl is not None else getattr(settings, 'FACT_CACHE_TTL', 21600)
+
+    def _host_path(self, host):
+        return os.path.join(self.path, host.replace(os.sep, "_") + ".json")
+
+    def is_fresh(self, host):
+        """Returns True if the facts of the host are younger than the TTL"""
+        try:
+            return time.time() - os.path.getmtime(self._host_path(host)) < self.ttl
+        except OSError:
+            return False
+
+    def get(self, host):
+        """Returns the cached facts of the host or None"""
+        try:
+            with open(self._host_path(host)) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, host, facts):
+        """Store the facts of the host"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(facts, cache_file)
+        os.rename(tmp_path, self._host_path(host))
@@ -1,33 +1,52 @@
-from control_panel.ansible_helpers import AnsibleInventory
+from django.conf import settings
+
+from control_panel.ansible_helpers import get_inventory
+from control_panel.audit import audit_sink
 from control_panel.deploy import AnsibleDeploy
+from control_panel.facts import FactCache
 
+from ansible.executor.task_queue_manager import TaskQueueManager
 from django_extensions.management.jobs import HourlyJob
 
+import time
+
+
 class Job(HourlyJob):
     help = "Host Information Gathering Job."
 
-    DEFAULT_OPTIONS = {
-        'ansible_connection': 'ssh',
-        'module_path': '/path/to/my/modules',
-        'forks': 100,
-        'ansible_remote_user': None,
-        'ansible_ssh_private_key_file': None,
-        'ansible_ssh_common_args': None,
-        'ansible_ssh_extra_args': None,
-        'ansible_become_user': None,
-        'ansible_become_method': None,
-        'ansible_become_user': None,
-        'check': False
-    }
-
     def execute(self):
-        inventory = AnsibleInventory()
-        all_hosts = inventory.unique_hosts_data
-        global_options = inventory.global_options
-        host_options = self.DEFAULT_OPTIONS.copy()
-        host_options.update(global_options[0])
-        for host in all_hosts:
-            host_options.update(host["vars"])
-            # handle status
-            status = AnsibleDeploy(options=host_options).deploy(
-                "hostname --ip-address", destination_host=host["name"], facts="yes")
+        """Gather the facts of all the hosts in parallel within the time budget
+
+        The hosts with fresh cached facts are left out. The rest are split
+        into batches of `forks` hosts and every batch is a single play. No new
+        batch starts once GATHER_TIME_BUDGET seconds have passed, the
+        remaining hosts are reported as skipped.
+        """
+        started = time.time()
+        time_budget = getattr(settings, 'GATHER_TIME_BUDGET', 3000)
+        host_timeout = getattr(settings, 'GATHER_HOST_TIMEOUT', 30)
+        inventory = get_inventory()
+        host_options = inventory.host_options()
+        host_options["timeout"] = host_timeout
+        fact_cache = FactCache()
+        all_hosts = sorted(inventory.hosts_vars)
+        hosts = [host for host in all_hosts if not fact_cache.is_fresh(host)]
+        batch_size = host_options["forks"]
+
+        status = {}
+        for i in range(0, len(hosts), batch_size):
+            if time.time() - started > time_budget:
+                break
+            status.update(AnsibleDeploy(options=host_options).gather_facts(
+                hosts[i:i + batch_size], timeout=host_timeout).status)
+
+        results = list(status.values())
+        log = "Gathered facts of {0} hosts in {1:.1f}s: {2} cached, {3} succeeded, {4} failed, {5} unreachable, {6} skipped".format(
+            len(all_hosts), time.time() - started, len(all_hosts) - len(hosts),
+            results.count(TaskQueueManager.RUN_OK),
+            results.count(TaskQueueManager.RUN_FAILED_HOSTS),
+            results.count(TaskQueueManager.RUN_UNREACHABLE_HOSTS),
+            len(hosts) - len(results))
+        print(log)
+        audit_sink.log(log, status="failed" if len(results) != results.count(TaskQueueManager.RUN_OK) else "ok")
+        audit_sink.flush()
@@ -0,0 +1,146 @@
+from collections import namedtuple
+from django.conf import settings
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Q
+
+from control_panel.models import Host, Region, Rule, RuleGroup
+
+from functools import reduce
+
+import operator
+
+
+LIST_PAGE_SIZE = getattr(settings, 'LIST_PAGE_SIZE', 100)
+
+MAX_LIST_PAGE_SIZE = 1000
+
+
+# How a table of objects is sorted, filtered and serialized. `sort_fields` and
+# `filters` map the names accepted in the query string to model lookups, so a
+# request can only sort or filter on the fields listed here. `q` is matched
+# against every one of `search_fields`. `columns` are the values of every
+# object in the JSON endpoint.
+Listing = namedtuple('Listing', ['queryset', 'related', 'sort_fields', 'default_sort',
+                                 'search_fields', 'filters', 'columns'])
+
+
+LISTINGS = {
+    'hosts': Listing(
+        queryset=Host.objects.exclude(name="all"),
+        related=('region', 'instance_type'),
+        sort_fields={'name': 'name', 'ip_address': 'ip_key', 'region': 'region__name',
+                     'instance_type': 'instance_type__name'},
+        default_sort=('name',),
+        search_fields=('name', 'ip_address', 'region__name'),
+        filters={'region': 'region__slug', 'host': 'name', 'is_active': 'is_active'},
+        columns=('id', 'name', 'ip_address', 'region__name', 'instance_type__name',
+                 'cpu', 'memory', 'distribution', 'kernel', 'is_active')),
+    'rules': Listing(
+        queryset=Rule.objects.all(),
+        related=('host__region', 'host__instance_type', 'target_region', 'target_host'),
+        sort_fields={'host': 'host__name', 'region': 'host__region__name',
+                     'interface': 'interface', 'target_region': 'target_region__name',
+                     'target_host': 'target_host__name', 'port': 'port_number',
+                     'latency': 'latency', 'bandwidth': 'bandwidth', 'created': 'created'},
+        default_sort=('-created', '-id'),
+        search_fields=('host__name', 'target_host__name', 'target_ip_address', 'interface'),
+        filters={'region': 'host__region__slug', 'host': 'host__name',
+                 'target_host': 'target_host__name', 'rule_group': 'rulegroup__name',
+                 'is_deployed': 'is_deployed'},
+        columns=('id', 'host__name', 'host__region__name', 'interface', 'src_port_number',
+                 'traffic_type', 'target_region__name', 'target_host__name',
+                 'target_ip_address', 'port_number', 'bandwidth', 'bw_rate', 'latency',
+                 'latency_time_unit', 'packet_loss', 'packet_corruption_rate',
+                 'is_deployed', 'created')),
+    'rule_groups': Listing(
+        queryset=RuleGroup.objects.all(),
+        related=(),
+        sort_fields={'name': 'name', 'created': 'created', 'is_active': 'is_active',
+                     'is_deployed': 'is_deployed'},
+        default_sort=('-created', '-id'),
+        search_fields=('name', 'description'),
+        filters={'is_active': 'is_active', 'is_deployed': 'is_deployed'},
+        columns=('id', 'name', 'description', 'is_active', 'is_deployed', 'created')),
+    'regions': Listing(
+        queryset=Region.objects.all(),
+        related=(),
+        sort_fields={'name': 'name', 'slug': 'slug'},
+        default_sort=('name',),
+        search_fields=('name', 'slug'),
+        filters={},
+        columns=('id', 'name', 'slug', 'internal_max_bandwidth', 'internal_bw_rate',
+                 'external_max_bandwidth', 'external_bw_rate', 'internal_latency',
+                 'internal_latency_time_unit', 'packet_loss', 'packet_corruption_rate')),
+}
+
+
+def _filter_value(value):
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return value
+
+
+def filter_listing(name, params, **lookups):
+    """Returns the sorted and filtered queryset of a listing
+
+    `params` is the query string of the request: `sort` names one of the sort
+    fields, prefixed with "-" for descending order, `q` is searched in the
+    search fields and every name of `filters` filters on its exact value.
+    `lookups` are extra filters applied by the view itself.
+    """
+    listing = LISTINGS[name]
+    queryset = listing.queryset.filter(**lookups)
+    for param, lookup in listing.filters.items():
+        if params.get(param):
+            queryset = queryset.filter(**{lookup: _filter_value(params[param])})
+    if params.get('q'):
+        queryset = queryset.filter(reduce(operator.or_, [
+            Q(**{field + '__icontains': params['q']}) for field in listing.search_fields]))
+    sort = params.get('sort', '')
+    if sort.lstrip('-') in listing.sort_fields:
+        prefix = '-' if sort.startswith('-') else ''
+        queryset = queryset.order_by(prefix + listing.sort_fields[sort.lstrip('-')], prefix + 'id')
+    else:
+        queryset = queryset.order_by(*listing.default_sort)
+    return queryset
+
+
+def paginate_listing(name, params, **lookups):
+    """Returns the requested page of a listing with its related objects loaded
+
+    A page costs two queries, the count and the objects themselves.
+    """
+    listing = LISTINGS[name]
+    queryset = filter_listing(name, params, **lookups)
+    if listing.related:
+        queryset = queryset.select_related(*listing.related)
+    try:
+        page_size = min(int(params.get('page_size', LIST_PAGE_SIZE)), MAX_LIST_PAGE_SIZE)
+    except ValueError:
+        page_size = LIST_PAGE_SIZE
+    paginator = Paginator(queryset, max(page_size, 1))
+    try:
+        return paginator.page(params.get('page', 1))
+    except PageNotAnInteger:
+        return paginator.page(1)
+    except EmptyPage:
+        return paginator.page(paginator.num_pages)
+
+
+def listing_values(name, params, **lookups):
+    """Returns the requested page of a listing as JSON serializable values"""
+    page = paginate_listing(name, params, **lookups)
+    columns = LISTINGS[name].columns
+    rows = page.paginator.object_list.values(*columns)[page.start_index() - 1:page.end_index()] \
+        if page.paginator.count else []
+    results = []
+    for row in rows:
+        if 'created' in row:
+            row['created'] = str(row['created'])
+        results.append(row)
+    return {
+        "count": page.paginator.count,
+        "page": page.number,
+        "num_pages": page.paginator.num_pages,
+        "results": results,
+    }
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from control_panel.models import Host, ip_key
+
+
+class Command(BaseCommand):
+    help = "Fills in the IP keys of the hosts that were saved before the keys existed."
+
+    def handle(self, *args, **options):
+        hosts = list(Host.objects.filter(ip_key='').values_list('id', 'ip_address'))
+        with transaction.atomic():
+            for host_id, ip_address in hosts:
+                Host.objects.filter(id=host_id).update(ip_key=ip_key(ip_address))
+        self.stdout.write("Filled in the IP keys of {0} hosts".format(len(hosts)))
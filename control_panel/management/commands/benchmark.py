@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from control_panel.benchmark import measure_startup, run_size
+
+import json
+import math
+import sys
+
+
+class Command(BaseCommand):
+    help = "Benchmarks compiling, deploying, deleting and gathering against a fake Ansible executor."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default="10,100,1000",
+                            help="Comma separated numbers of hosts to benchmark.")
+        parser.add_argument('--hosts-per-region', type=int, default=50,
+                            help="Hosts per region, every region gets a full-mesh deployment group.")
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help="Seconds that every task of the fake executor takes per batch of forks.")
+        parser.add_argument('--output', default=None,
+                            help="Write the JSON report to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(",") if size.strip()]
+        startup = measure_startup()
+        # The benchmark seeds and flushes its own throw-away test database
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        stdout = sys.stdout
+        reports = []
+        try:
+            for size in sizes:
+                n_regions = max(int(math.ceil(size / float(options['hosts_per_region']))), 1)
+                # The deploy and gather paths print their progress
+                sys.stdout = sys.stderr
+                try:
+                    reports.append(run_size(size, n_regions, latency=options['latency']))
+                finally:
+                    sys.stdout = stdout
+                self.stderr.write("Benchmarked {0} hosts".format(size))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = json.dumps({"latency": options['latency'], "startup_seconds": startup, "sizes": reports}, indent=4, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report + "\n")
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from control_panel.ansible_helpers import close_ssh_connections, get_inventory
+from control_panel.deploy import AnsibleDeploy
+
+import json
+import time
+
+
+class Command(BaseCommand):
+    help = "Measures the latency of repeated deploys to a host with and without persistent SSH connections."
+
+    def add_arguments(self, parser):
+        parser.add_argument('host', help="The inventory name of the host.")
+        parser.add_argument('--rounds', type=int, default=50,
+                            help="Number of plays to run in each mode.")
+        parser.add_argument('--command', default="true",
+                            help="The command that every play runs on the host.")
+
+    def _rounds(self, host, options, rounds, command):
+        durations = []
+        for _ in range(rounds):
+            started = time.time()
+            AnsibleDeploy(options=options).deploy_batch({host: command})
+            durations.append(time.time() - started)
+        durations.sort()
+        return {
+            "rounds": rounds,
+            "total": round(sum(durations), 3),
+            "slowest": round(durations[-1], 3),
+            "median": round(durations[len(durations) // 2], 3),
+            "mean": round(sum(durations) / len(durations), 3),
+        }
+
+    def handle(self, *args, **options):
+        inventory = get_inventory()
+        host = options['host']
+        report = {"host": host}
+        for mode, persist in (("plain", False), ("persistent", True)):
+            # Every mode starts without an open connection to the host
+            close_ssh_connections()
+            report[mode] = self._rounds(host, inventory.host_options(host, persist=persist),
+                                        options['rounds'], options['command'])
+        close_ssh_connections()
+        self.stdout.write(json.dumps(report, indent=4))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from control_panel.ansible_helpers import close_ssh_connections
+
+
+class Command(BaseCommand):
+    help = "Closes the persistent SSH connections that the panel keeps to the hosts."
+
+    def handle(self, *args, **options):
+        self.stdout.write("Closed {0} SSH connections".format(close_ssh_connections()))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from control_panel.models import Host
+from control_panel.verify import collect_snapshots, verify_hosts
+
+import json
+
+
+class Command(BaseCommand):
+    help = "Collects the live shaping of the hosts with tcshow and reports the drift from their deployed rules."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', action='append', dest='hosts', default=[],
+                            help="Only collect the snapshot of this host, can be repeated.")
+
+    def handle(self, *args, **options):
+        hosts = Host.objects.filter(Q(rule__isnull=False) | Q(shapingstate__isnull=False)).distinct()
+        if options['hosts']:
+            hosts = hosts.filter(name__in=options['hosts'])
+        hosts = list(hosts)
+        collect_snapshots(hosts)
+        self.stdout.write(json.dumps(verify_hosts(hosts), indent=4))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from control_panel.mesh import build_full_mesh
+from control_panel.models import Host, RuleGroup
+
+
+class Command(BaseCommand):
+    help = "Creates a full mesh of rules between hosts in a deployment group."
+
+    def add_arguments(self, parser):
+        parser.add_argument('rule_group', help="Name of the deployment group, created if missing.")
+        parser.add_argument('--region', action='append', default=[],
+                            help="Slug of a region whose hosts join the mesh, can be repeated.")
+        parser.add_argument('--host', action='append', default=[],
+                            help="Name of a host that joins the mesh, can be repeated.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of rows per bulk insert, at most what the database accepts.")
+
+    def handle(self, *args, **options):
+        hosts = Host.objects.exclude(region__isnull=True)
+        if options['region']:
+            hosts = hosts.filter(region__slug__in=options['region'])
+        if options['host']:
+            hosts = hosts.filter(name__in=options['host'])
+        if not hosts.exists():
+            raise CommandError("No hosts with a region match the selection.")
+        rule_group, created = RuleGroup.objects.get_or_create(name=options['rule_group'])
+        count = build_full_mesh(rule_group, hosts, batch_size=options['batch_size'])
+        self.stdout.write("Added {0} rules to {1}".format(count, rule_group))
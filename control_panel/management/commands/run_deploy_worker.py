@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from control_panel.tasks import recover_deploy_jobs, run_pending_jobs
+
+import time
+
+
+class Command(BaseCommand):
+    help = "Runs the pending deployment jobs of the database backed queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2,
+                            help="Seconds to wait between polls for new jobs.")
+        parser.add_argument('--once', action='store_true',
+                            help="Run the pending jobs and exit.")
+
+    def handle(self, *args, **options):
+        job_ids = recover_deploy_jobs()
+        while True:
+            for job_id in job_ids:
+                self.stdout.write("Ran deploy job {0}".format(job_id))
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+            job_ids = run_pending_jobs()
@@ -0,0 +1,66 @@
+from django.db import connection, transaction
+from django.db.models import AutoField, Max
+
+from control_panel.models import Host, Rule, RuleGroup
+from control_panel.overview import invalidate_overview
+
+
+def mesh_rule(src_host, dst_host):
+    """Returns an unsaved Rule from a host to another one based on the source instance type"""
+    rule = Rule(host=src_host, target_host=dst_host, target_region_id=dst_host.region_id)
+    if src_host.instance_type:
+        rule.bandwidth = src_host.instance_type.bandwidth
+        rule.latency = src_host.instance_type.latency
+        rule.interface = src_host.interface
+        rule.bw_rate = src_host.instance_type.bw_rate
+        rule.packet_loss = src_host.instance_type.packet_loss
+        rule.packet_corruption_rate = src_host.instance_type.packet_corruption_rate
+        rule.latency_time_unit = src_host.instance_type.latency_time_unit
+    return rule
+
+
+def bulk_batch_size(model, objs, batch_size):
+    """Cap a batch size to the number of rows the database accepts in one insert
+
+    An explicit batch size passed to bulk_create is not checked against the
+    limits of the database, such as the 999 query parameters of SQLite.
+    """
+    fields = [field for field in model._meta.concrete_fields if not isinstance(field, AutoField)]
+    return max(min(batch_size, connection.ops.bulk_batch_size(fields, objs)), 1)
+
+
+@transaction.atomic
+def build_full_mesh(rule_group, hosts, batch_size=500):
+    """Create a rule for every ordered pair of hosts and add them to the rule group
+
+    `hosts` is a queryset or a list of host ids. The hosts are loaded with a
+    single query and the rules and their rule group links are inserted in
+    bulk, so the number of queries depends on the batch size only, capped to
+    what the database accepts in one insert. Returns
+    the number of rules that were created.
+    """
+    if not hasattr(hosts, 'select_related'):
+        hosts = Host.objects.filter(id__in=list(hosts))
+    hosts = list(hosts.select_related('instance_type'))
+    rules = [mesh_rule(src_host, dst_host)
+             for src_host in hosts for dst_host in hosts if src_host.id != dst_host.id]
+    if not rules:
+        return 0
+
+    last_id = Rule.objects.aggregate(Max('id'))['id__max'] or 0
+    Rule.objects.bulk_create(rules, batch_size=bulk_batch_size(Rule, rules, batch_size))
+    if rules[0].pk is not None:
+        rule_ids = [rule.pk for rule in rules]
+    else:
+        # The database does not return the primary keys of bulk inserts
+        pairs = set((rule.host_id, rule.target_host_id) for rule in rules)
+        rule_ids = [rule_id for rule_id, host_id, target_host_id in
+                    Rule.objects.filter(id__gt=last_id).values_list('id', 'host_id', 'target_host_id')
+                    if (host_id, target_host_id) in pairs]
+
+    Membership = RuleGroup.rule.through
+    memberships = [Membership(rulegroup_id=rule_group.id, rule_id=rule_id) for rule_id in rule_ids]
+    Membership.objects.bulk_create(
+        memberships, batch_size=bulk_batch_size(Membership, memberships, batch_size))
+    invalidate_overview()
+    return len(rule_ids)
@@ -3,16 +3,42 @@ from __future__ import unicode_literals
 from django.contrib.auth.models import User, Group
 from django.db import models
 from django.template.defaultfilters import slugify
+from django.utils import timezone
 
 from control_panel.choices import *
 
+import ipaddr
+
+
+def ip_key(address):
+    """Returns the fixed width hex key of an IP address
+
+    IPv4 addresses are mapped into ::ffff:0:0/96, so the keys of IPv4 and
+    IPv6 addresses sort like the 128-bit numbers they stand for and a network
+    becomes a range of keys.
+    """
+    address = ipaddr.IPAddress(address)
+    value = int(address)
+    if address.version == 4:
+        value |= 0xffff << 32
+    return "%032x" % value
+
+
+def ip_key_range(network):
+    """Returns the first and the last key of the addresses in a network"""
+    network = ipaddr.IPNetwork(network)
+    return ip_key(network.network), ip_key(network.broadcast)
+
 
 class Audit(models.Model):
-    timestamp = models.CharField(max_length=255)
+    timestamp = models.DateTimeField(default=timezone.now)
     user = models.ForeignKey(User, null=True)
     status = models.CharField(max_length=255, default="")
     log = models.CharField(max_length=255)
 
+    class Meta:
+        index_together = (('timestamp', 'id'),)
+
 
 class Region(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -69,9 +95,14 @@ class Host(models.Model):
     distribution = models.CharField(max_length=255, default='')
     kernel = models.CharField(max_length=255, default='')
     ip_address = models.GenericIPAddressField()
+    ip_key = models.CharField(max_length=32, db_index=True, default='')
     is_active = models.BooleanField(default=False)
     inventory_groups = models.ManyToManyField(InventoryGroup)
 
+    def save(self, *args, **kwargs):
+        self.ip_key = ip_key(self.ip_address)
+        super(Host, self).save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
@@ -125,6 +156,65 @@ class RuleGroup(models.Model):
         return self.name
 
 
+class ShapingState(models.Model):
+    host = models.ForeignKey(Host, on_delete=models.CASCADE)
+    interface = models.CharField(max_length=255)
+    fingerprints = models.TextField(default="{}")
+    tcsets = models.TextField(default="{}")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('host', 'interface')
+
+    def __str__(self):
+        return "{0} {1}".format(self.host, self.interface)
+
+
+class ShapingSnapshot(models.Model):
+    host = models.OneToOneField(Host, on_delete=models.CASCADE)
+    status = models.IntegerField(default=0)
+    settings = models.TextField(null=True, blank=True)
+    collected = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "{0} {1}".format(self.host, self.collected)
+
+
+class TopologyMap(models.Model):
+    checksum = models.CharField(max_length=40)
+    host_regions = models.TextField(default="{}")
+    pushed = models.DateTimeField(auto_now_add=True)
+
+
+class DeployJob(models.Model):
+    PENDING, RUNNING, FINISHED, FAILED = 1, 2, 3, 4
+
+    user = models.ForeignKey(User, null=True)
+    rule_groups = models.ManyToManyField(RuleGroup)
+    is_undeploy = models.BooleanField(default=False)
+    status = models.IntegerField(choices=JOB_STATUS_CHOICES, default=PENDING)
+    progress = models.TextField(default="{}")
+    # JSON of the interfaces to tear down keyed by host id, set on the jobs
+    # that reapply the shaping of the hosts that rules were deleted from
+    teardown = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "Deploy job {0}".format(self.id)
+
+
+class ShapingLock(models.Model):
+    """The lock that a job holds while it changes the shaping of hosts
+
+    The table has a single row. `holder` names the job that holds the lock,
+    the lock is free when it is empty. `acquired` is refreshed while the job
+    runs, so that the lock of a process that died can be taken over.
+    """
+    holder = models.CharField(max_length=255, default='')
+    acquired = models.DateTimeField(null=True, blank=True)
+
+
 class TrafficControlGroup(models.Model):
     region = models.ForeignKey(Region, on_delete=models.CASCADE)
     rule_group = models.ForeignKey(RuleGroup, on_delete=models.CASCADE)
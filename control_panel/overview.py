@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+
+from control_panel.compiler import RuleCompiler
+from control_panel.models import RuleGroup, WAN
+
+import json
+
+
+def _latency_label(latencies):
+    if not latencies:
+        return ""
+    low, high = min(latencies), max(latencies)
+    if low == high:
+        return "{0:g} ms".format(low)
+    return "{0:g}-{1:g} ms".format(low, high)
+
+
+def build_overview():
+    """Build the nodes and edges of the bird's eye graph
+
+    Every deployment group gets a node per region of its rule hosts and every
+    host is linked to its region with the latency that its rules apply, the
+    same latency the RuleCompiler puts in the tcset commands. The rules, their
+    hosts and their groups come from a single query over the group to rule
+    links.
+    """
+    Membership = RuleGroup.rule.through
+    links = list(Membership.objects.select_related(
+        'rulegroup', 'rule__host__region', 'rule__host__instance_type',
+        'rule__target_region', 'rule__target_host__region',
+        'rule__target_host__instance_type').order_by('rulegroup_id', 'rule_id'))
+    compiler = RuleCompiler([link.rule for link in links])
+
+    group_hosts = OrderedDict()
+    for link in links:
+        rule = link.rule
+        if rule.host is None or rule.host.region is None:
+            continue
+        latencies = []
+        for target_host in compiler.target_hosts(rule):
+            try:
+                path = compiler.path_costs.path(rule.host.region_id, target_host.region_id)
+            except (KeyError, WAN.DoesNotExist):
+                continue
+            instance_latency = rule.host.instance_type.latency if rule.host.instance_type else 0
+            latencies.append(rule.latency + instance_latency + path.latency)
+        regions = group_hosts.setdefault(link.rulegroup_id, OrderedDict())
+        hosts = regions.setdefault(rule.host.region, OrderedDict())
+        hosts.setdefault(rule.host, []).extend(latencies)
+
+    nodes = []
+    edges = []
+    for regions in group_hosts.values():
+        for region, hosts in sorted(regions.items(), key=lambda item: item[0].name):
+            region_node = len(nodes)
+            nodes.append({'id': region_node, 'label': str(region)})
+            for host, latencies in hosts.items():
+                nodes.append({'id': len(nodes), 'label': str(host.ip_address), 'group': str(region)})
+                edges.append({'from': region_node, 'to': len(nodes) - 1, 'length': str(200),
+                              'label': _latency_label(latencies)})
+    return {'nodes': nodes, 'edges': edges}
+
+
+# The graph is kept in the shared cache, so every web and worker process
+# serves and invalidates the same copy
+OVERVIEW_CACHE_KEY = 'tc-panel-overview'
+
+
+def get_overview_json():
+    """Returns the bird's eye graph as JSON, building it when it is not cached"""
+    overview = cache.get(OVERVIEW_CACHE_KEY)
+    if overview is None:
+        # Escape "<" so that the JSON can be embedded in a <script> element
+        overview = json.dumps(build_overview()).replace("<", "\\u003c")
+        cache.set(OVERVIEW_CACHE_KEY, overview, getattr(settings, 'OVERVIEW_CACHE_TTL', 300))
+    return overview
+
+
+def invalidate_overview(**kwargs):
+    """Drop the cached bird's eye graph, it is rebuilt on next use"""
+    cache.delete(OVERVIEW_CACHE_KEY)
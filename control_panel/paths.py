@@ -0,0 +1,94 @@
+from array import array
+from collections import namedtuple
+
+from control_panel.models import Region, WAN
+
+import operator
+
+
+PathCost = namedtuple('PathCost', ['latency', 'bandwidth', 'bw_rate',
+                                   'packet_loss', 'packet_corruption_rate'])
+
+
+class PathCostMatrix(object):
+    """The aggregated network characteristics between every pair of regions
+
+    Each characteristic is kept in a flat array of `len(regions) ** 2`
+    entries, where the entry of a (source, destination) pair is found through
+    the position of the region ids. The latency, the packet loss and the
+    packet corruption rate are the sums over the internal networks of the
+    regions and the WAN that connects them. The bandwidth is the narrowest
+    one along the path, a `bw_rate` of 0 marks a path without a bandwidth
+    limit. The instance type and the rule characteristics are added on top
+    by the RuleCompiler.
+    """
+
+    def __init__(self, regions, wans):
+        regions = list(regions)
+        wans = {wan.name: wan for wan in wans}
+        self.index = {region.id: i for i, region in enumerate(regions)}
+        self.size = len(regions)
+        cells = self.size * self.size
+        self.latency = array('d', [0.0]) * cells
+        self.bandwidth = array('d', [0.0]) * cells
+        self.bw_rate = array('b', [0]) * cells
+        self.packet_loss = array('d', [0.0]) * cells
+        self.packet_corruption_rate = array('d', [0.0]) * cells
+        self.has_wan = array('b', [1]) * cells
+
+        for src in regions:
+            for dst in regions:
+                cell = self.index[src.id] * self.size + self.index[dst.id]
+                latency = src.internal_latency
+                packet_loss = src.packet_loss
+                packet_corruption_rate = src.packet_corruption_rate
+                if src.id == dst.id:
+                    bandwidths = [(dst.internal_max_bandwidth, dst.internal_bw_rate)]
+                else:
+                    wan = self._wan(wans, src, dst)
+                    if wan is None:
+                        self.has_wan[cell] = 0
+                        continue
+                    bandwidths = [(src.external_max_bandwidth, src.external_bw_rate),
+                                  (dst.external_max_bandwidth, dst.external_bw_rate),
+                                  (wan.bandwidth, wan.bw_rate)]
+                    latency += dst.internal_latency + wan.latency
+                    packet_loss += dst.packet_loss + wan.packet_loss
+                    packet_corruption_rate += dst.packet_corruption_rate + \
+                        wan.packet_corruption_rate
+                bandwidths = [tp for tp in bandwidths if all(tp)]
+                if bandwidths:
+                    self.bandwidth[cell], self.bw_rate[cell] = min(
+                        bandwidths, key=operator.itemgetter(1, 0))
+                self.latency[cell] = latency
+                self.packet_loss[cell] = packet_loss
+                self.packet_corruption_rate[cell] = packet_corruption_rate
+
+    @staticmethod
+    def _wan(wans, src, dst):
+        """Returns the WAN that connects two regions"""
+        for name in ("{0}_{1}".format(dst.slug, src.slug),
+                     "{0}_{1}".format(src.slug, dst.slug),
+                     "{0}".format(src.slug)):
+            if name in wans:
+                return wans[name]
+        return None
+
+    def path(self, src_region_id, dst_region_id):
+        """Returns the PathCost from a source to a destination region"""
+        cell = self.index[src_region_id] * self.size + self.index[dst_region_id]
+        if not self.has_wan[cell]:
+            raise WAN.DoesNotExist("No WAN between regions {0} and {1}".format(
+                src_region_id, dst_region_id))
+        return PathCost(self.latency[cell], self.bandwidth[cell], self.bw_rate[cell],
+                        self.packet_loss[cell], self.packet_corruption_rate[cell])
+
+
+def get_path_costs():
+    """Build the PathCostMatrix of the current regions and WANs with two queries
+
+    The matrix is not cached across calls, so a compile always sees the
+    regions and WANs as they are in the database, whatever process changed
+    them.
+    """
+    return PathCostMatrix(Region.objects.all(), WAN.objects.all())
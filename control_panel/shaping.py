@@ -0,0 +1,219 @@
+from collections import defaultdict, OrderedDict
+from django.conf import settings
+
+from control_panel.compiler import RuleCompiler, aggregate_tcsets, format_tcset
+from control_panel.models import ShapingSnapshot, ShapingState
+
+import hashlib
+import ipaddr
+import json
+
+
+FILTER_KEYS = ('direction', 'dst-network', 'port', 'src-port')
+
+
+def shaping_key(tcset):
+    """Returns the key of the tc filter that a tcset command installs"""
+    return ",".join("{0}={1}".format(key, tcset.get(key) or "") for key in FILTER_KEYS)
+
+
+def fingerprint(tcset):
+    """Returns a fingerprint of the tcset arguments"""
+    return hashlib.sha1(format_tcset(tcset).encode('utf-8')).hexdigest()
+
+
+def format_tcdel(interface, key):
+    """Convert a shaping key to the tcdel command that removes its filter
+
+    A filter that is already gone from the host does not fail the command.
+    """
+    construct_cmd = ["--device " + interface]
+    for item in key.split(","):
+        name, value = item.split("=", 1)
+        if value:
+            construct_cmd.append("--" + name + " " + value)
+    return "tcdel " + " ".join(construct_cmd) + " || true;"
+
+
+def tc_settings(interfaces):
+    """Convert the tcset arguments of the interfaces of a host to a tcconfig setting
+
+    The setting is the JSON document that `tcset --import-setting` applies,
+    keyed by interface, direction and filter.
+    """
+    setting = OrderedDict()
+    for interface, tcsets in sorted(interfaces.items()):
+        for tcset in tcsets.values():
+            tc_filter = []
+            if tcset.get('dst-network'):
+                tc_filter.append("dst-network={0}".format(ipaddr.IPNetwork(tcset['dst-network'])))
+            if tcset.get('src-port'):
+                tc_filter.append("src-port={0}".format(tcset['src-port']))
+            if tcset.get('port'):
+                tc_filter.append("dst-port={0}".format(tcset['port']))
+            tc_filter.append("protocol=ip")
+            params = OrderedDict()
+            params['delay'] = tcset['delay']
+            params['rate'] = tcset['rate']
+            if tcset.get('loss'):
+                params['loss'] = "{0}%".format(tcset['loss'])
+            if tcset.get('corrupt'):
+                params['corrupt'] = "{0}%".format(tcset['corrupt'])
+            directions = setting.setdefault(interface, OrderedDict())
+            directions.setdefault(tcset['direction'], OrderedDict())[", ".join(tc_filter)] = params
+    return setting
+
+
+def format_teardown(interface):
+    """Returns the command that removes every filter of an interface, if it has any"""
+    return "tcdel --device {0} --all || true;".format(interface)
+
+
+def format_import_setting(setting, cleared_interfaces=()):
+    """Returns the command that writes a tcconfig setting on a host and applies it at once
+
+    The setting is written to a new file made by mktemp, never to a fixed
+    path that another user of the host could have replaced with a symlink,
+    and the file is removed once applied.
+    """
+    cmd = [format_teardown(interface) for interface in cleared_interfaces]
+    if setting:
+        cmd.append("""tc_setting=$(mktemp) && cat > "$tc_setting" << 'EOF'
+{0}
+EOF
+tcset --import-setting "$tc_setting"; tc_status=$?; rm -f "$tc_setting"; [ $tc_status -eq 0 ];""".format(
+            json.dumps(setting, indent=4)))
+    return "\n".join(cmd)
+
+
+class ShapingPlan(object):
+    """The difference between the desired and the applied shaping of hosts
+
+    The desired shaping is compiled from the rules that should be active on
+    the hosts, the applied shaping comes from the ShapingState of every host
+    interface. Only the filters that were added, changed or removed end up in
+    the commands, so hosts that are already up to date are not touched.
+
+    With `aggregate` the destinations that share the same shaping are
+    collapsed to network blocks, so each host carries a filter per shaping
+    profile and block instead of one per destination host.
+
+    In the "commands" mode every changed filter is a tcset or tcdel call, and
+    the first tcset that fails stops the commands of the host and fails it.
+    In the "import" mode every changed host gets its whole shaping compiled to
+    a single tcconfig setting that is applied at once with
+    `tcset --import-setting`, once every interface that the host has or
+    should have shaped is torn down.
+
+    `teardown` maps host ids to interfaces that must be cleared. Those hosts
+    are rebuilt from scratch whatever their applied shaping: the interfaces,
+    along with every applied or desired one, are torn down and all the
+    desired filters are set again.
+    """
+
+    def __init__(self, hosts, rules, mode=None, aggregate=None, teardown=None):
+        self.mode = mode or getattr(settings, 'TC_DEPLOY_MODE', 'commands')
+        if aggregate is None:
+            aggregate = getattr(settings, 'TC_AGGREGATE_NETWORKS', False)
+        self.hosts = dict((host.id, host) for host in hosts)
+        compiler = RuleCompiler(rules)
+        host_tcsets = defaultdict(list)
+        for rule in compiler.rules:
+            host_tcsets[rule.host_id].extend(compiler.tcset_settings(rule))
+        self.desired = defaultdict(OrderedDict)
+        for host_id, tcsets in host_tcsets.items():
+            if aggregate:
+                tcsets = aggregate_tcsets(tcsets)
+            for tcset in tcsets:
+                self.desired[(host_id, tcset['device'])][shaping_key(tcset)] = tcset
+        self.applied = dict(((state.host_id, state.interface), state)
+                            for state in ShapingState.objects.filter(host__in=list(self.hosts)))
+        self.teardown = dict((host_id, set(interfaces))
+                             for host_id, interfaces in (teardown or {}).items())
+        self.verified = set()
+        self.changes = self._diff()
+
+    def _teardown_interfaces(self, host_id):
+        """Returns the interfaces that a rebuilt host has torn down"""
+        return sorted(self.teardown.get(host_id, set()) | set(
+            interface for shaped_host_id, interface in set(self.desired) | set(self.applied)
+            if shaped_host_id == host_id))
+
+    def use_snapshots(self, reports):
+        """Trust the live shaping of the hosts over their recorded ShapingState
+
+        `reports` are the verification reports of the hosts keyed by host id.
+        Hosts with a fresh snapshot that already matches the desired shaping
+        are left out. Hosts with a fresh snapshot that drifted from the
+        applied shaping, the one recorded in their ShapingState, are rebuilt
+        from scratch. The rest keep the incremental diff.
+        """
+        for host_id, report in reports.items():
+            if report["stale"]:
+                continue
+            if report["status"] == "in_sync":
+                self.verified.add(host_id)
+            elif report.get("applied_status") == "drift":
+                self.teardown.setdefault(host_id, set())
+        self.changes = self._diff()
+
+    def _diff(self):
+        changes = defaultdict(list)
+        for host_id in sorted(self.teardown):
+            interfaces = self._teardown_interfaces(host_id)
+            changes[host_id].extend(format_teardown(interface) for interface in interfaces)
+            for interface in interfaces:
+                changes[host_id].extend(format_tcset(tcset) for tcset in
+                                        self.desired.get((host_id, interface), {}).values())
+        for host_id, interface in sorted(set(self.desired) | set(self.applied)):
+            if host_id in self.teardown or host_id in self.verified:
+                continue
+            desired = self.desired.get((host_id, interface), {})
+            applied = {}
+            if (host_id, interface) in self.applied:
+                applied = json.loads(self.applied[(host_id, interface)].fingerprints)
+            for key in applied:
+                if key not in desired:
+                    changes[host_id].append(format_tcdel(interface, key))
+            for key, tcset in desired.items():
+                if applied.get(key) != fingerprint(tcset):
+                    changes[host_id].append(format_tcset(tcset))
+        return changes
+
+    def commands(self):
+        """Returns the commands that bring each changed host up to date keyed by host name"""
+        if self.mode == 'import':
+            return dict((self.hosts[host_id].name, self._import_command(host_id))
+                        for host_id in self.changes)
+        return dict((self.hosts[host_id].name, "set -e; " + " ".join(cmds))
+                    for host_id, cmds in self.changes.items())
+
+    def _import_command(self, host_id):
+        interfaces = dict((interface, tcsets) for (desired_host_id, interface), tcsets
+                          in self.desired.items() if desired_host_id == host_id and tcsets)
+        return format_import_setting(tc_settings(interfaces), self._teardown_interfaces(host_id))
+
+    def record(self, status):
+        """Store the desired shaping of the hosts that were deployed successfully
+
+        The verified hosts are stored as well. The snapshots of the changed
+        hosts no longer show their live shaping and are dropped.
+        """
+        if self.changes:
+            ShapingSnapshot.objects.filter(host__in=list(self.changes)).delete()
+        for host_id, interface in set(self.desired) | set(self.applied):
+            is_deployed = host_id in self.changes and status.get(self.hosts[host_id].name) == 0
+            if not is_deployed and host_id not in self.verified:
+                continue
+            desired = self.desired.get((host_id, interface))
+            state = self.applied.get((host_id, interface))
+            if not desired:
+                if state is not None:
+                    state.delete()
+                continue
+            if state is None:
+                state = ShapingState(host_id=host_id, interface=interface)
+            state.fingerprints = json.dumps(dict(
+                (key, fingerprint(tcset)) for key, tcset in desired.items()))
+            state.tcsets = json.dumps(desired)
+            state.save()
@@ -0,0 +1,22 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from control_panel.models import Host, InstanceType, Region, Rule, RuleGroup, WAN
+from control_panel.overview import invalidate_overview
+
+
+@receiver(post_save, sender=Region)
+@receiver(post_delete, sender=Region)
+@receiver(post_save, sender=WAN)
+@receiver(post_delete, sender=WAN)
+@receiver(post_save, sender=Rule)
+@receiver(post_delete, sender=Rule)
+@receiver(post_save, sender=Host)
+@receiver(post_delete, sender=Host)
+@receiver(post_save, sender=InstanceType)
+@receiver(post_delete, sender=InstanceType)
+@receiver(post_delete, sender=RuleGroup)
+@receiver(m2m_changed, sender=RuleGroup.rule.through)
+def overview_changed(sender, **kwargs):
+    """Rebuild the bird's eye graph when a path, a rule, a host or a deployment group changes"""
+    invalidate_overview()
@@ -41,3 +41,17 @@ function readMessage(messageID, choice, recipient, meeting) {
         });
 }
 
+/** Poll the progress of a deployment job until it is finished **/
+function pollDeployJob(elementID) {
+    var element = document.getElementById(elementID);
+    $.getJSON(element.getAttribute("data-url"), function(job) {
+        var hosts = [];
+        for (var host in job.hosts) {
+            hosts.push(host + ": " + job.hosts[host]);
+        }
+        document.getElementById(elementID + "-status").innerHTML = job.status + " " + hosts.join(", ");
+        if (job.status == "Pending" || job.status == "Running") {
+            setTimeout(function() { pollDeployJob(elementID); }, 2000);
+        }
+    });
+}
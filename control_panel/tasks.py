@@ -0,0 +1,491 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.six.moves import queue
+
+from control_panel.ansible_helpers import get_inventory
+from control_panel.audit import audit_sink
+from control_panel.deploy import AnsibleDeploy
+from control_panel.models import DeployJob, Host, Rule, ShapingLock, TopologyMap
+from control_panel.shaping import ShapingPlan
+from control_panel.topology import TOPOLOGY_MAP_PATH, TopologyMapUpdate
+from control_panel.verify import collect_snapshots, verify_plan
+
+from ansible.executor.task_queue_manager import TaskQueueManager
+
+from notifications.models import Notification
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+HOST_STATUS = {TaskQueueManager.RUN_OK: "deployed",
+               TaskQueueManager.RUN_FAILED_HOSTS: "failed",
+               TaskQueueManager.RUN_UNREACHABLE_HOSTS: "unreachable"}
+
+# Hosts listed in a deploy notification and characters of error output kept per host
+NOTIFICATION_HOSTS = getattr(settings, 'NOTIFICATION_HOSTS', 20)
+NOTIFICATION_EXCERPT = getattr(settings, 'NOTIFICATION_EXCERPT', 200)
+
+# Minimum seconds between two writes of the progress of a running deploy job
+PROGRESS_INTERVAL = getattr(settings, 'DEPLOY_PROGRESS_INTERVAL', 1)
+
+
+class WorkerPool(object):
+    """A pool of daemon threads that runs the queued callables in the background"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """Start the worker threads on first use"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name="tc-panel-worker-{0}".format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                close_old_connections()
+                func(*args)
+            except Exception:
+                logger.exception("Background task %s failed", func.__name__)
+            finally:
+                audit_sink.flush()
+                close_old_connections()
+                self.queue.task_done()
+
+    def submit(self, func, *args):
+        """Queue a callable to run in one of the worker threads"""
+        self._start()
+        self.queue.put((func, args))
+
+
+pool = WorkerPool(getattr(settings, 'DEPLOY_WORKERS', 1))
+
+# Seconds after which the shaping lock of a job that stopped refreshing it is
+# taken over
+SHAPING_LOCK_TIMEOUT = getattr(settings, 'SHAPING_LOCK_TIMEOUT', 600)
+
+
+def _lock_holder(job_id):
+    return "job {0}".format(job_id)
+
+
+def acquire_shaping_lock(holder):
+    """Take the shaping lock, returns False if another holder has it
+
+    Jobs that change the shaping of hosts run one at a time across all the
+    processes, each one builds its ShapingPlan from the ShapingState that the
+    previous one recorded. The lock is taken with a single conditional
+    UPDATE, so two processes cannot both get it.
+    """
+    ShapingLock.objects.get_or_create(id=1)
+    now = timezone.now()
+    return ShapingLock.objects.filter(id=1).filter(
+        Q(holder='') | Q(holder=holder) |
+        Q(acquired__lt=now - timedelta(seconds=SHAPING_LOCK_TIMEOUT))).update(
+        holder=holder, acquired=now) == 1
+
+
+def refresh_shaping_lock(holder):
+    """Tell the other processes that the holder of the shaping lock is still running"""
+    ShapingLock.objects.filter(id=1, holder=holder).update(acquired=timezone.now())
+
+
+def release_shaping_lock(holder):
+    ShapingLock.objects.filter(id=1, holder=holder).update(holder='', acquired=None)
+
+
+def _queue_job(job):
+    """Run a pending job in the local worker pool with the "thread" backend
+
+    With the "database" backend the job stays pending until a
+    `manage.py run_deploy_worker` process runs it.
+    """
+    if getattr(settings, 'DEPLOY_QUEUE_BACKEND', 'thread') == 'thread':
+        pool.submit(run_pending_jobs)
+    return job
+
+
+def enqueue_deploy(user, rule_group_ids, is_undeploy=False):
+    """Create a deployment job for the rule groups and queue it"""
+    job = DeployJob.objects.create(user=user, is_undeploy=is_undeploy)
+    job.rule_groups.add(*rule_group_ids)
+    return _queue_job(job)
+
+
+def claim_deploy_job(job_id):
+    """Take the shaping lock for a pending job and mark the job as running
+
+    Returns False if another worker got the job first or another job holds
+    the lock. Once the lock is taken no other job can be running, the ones
+    still marked as running were left by a process that stopped and are
+    marked as failed.
+    """
+    holder = _lock_holder(job_id)
+    if not acquire_shaping_lock(holder):
+        return False
+    if DeployJob.objects.filter(id=job_id, status=DeployJob.PENDING).update(
+            status=DeployJob.RUNNING) != 1:
+        release_shaping_lock(holder)
+        return False
+    _fail_orphaned_jobs(exclude=job_id)
+    return True
+
+
+def _fail_orphaned_jobs(exclude=None):
+    jobs = DeployJob.objects.filter(status=DeployJob.RUNNING)
+    if exclude is not None:
+        jobs = jobs.exclude(id=exclude)
+    count = jobs.update(status=DeployJob.FAILED, finished=timezone.now())
+    if count:
+        logger.warning("Marked %d deploy jobs left running by a stopped process as failed", count)
+
+
+def run_deploy_job(job_id):
+    """Claim a pending job, deploy it and notify the user once it is finished
+
+    The rules that should be active on every affected host are compiled and
+    compared with the shaping that was last applied to the host, so only the
+    filters that changed are sent. The commands of all the hosts are deployed
+    with a single play, so that the hosts are configured in parallel.
+    Returns the status code of every host, or None if the job could not be
+    claimed.
+    """
+    if not claim_deploy_job(job_id):
+        return None
+    try:
+        job = DeployJob.objects.get(id=job_id)
+        if job.teardown is not None:
+            teardown = dict((int(host_id), interfaces)
+                            for host_id, interfaces in json.loads(job.teardown).items())
+            return _run_job(job, _reapply_hosts, teardown)
+        return _run_job(job, _deploy_job_rules)
+    finally:
+        release_shaping_lock(_lock_holder(job_id))
+
+
+def run_pending_jobs():
+    """Run the pending jobs in order until none is left
+
+    Stops early when another job holds the shaping lock, the process that
+    runs it picks up the jobs left once it is finished. Returns the ids of
+    the jobs that ran.
+    """
+    ran = []
+    while True:
+        job_id = DeployJob.objects.filter(status=DeployJob.PENDING).order_by(
+            'id').values_list('id', flat=True).first()
+        if job_id is None:
+            return ran
+        try:
+            if run_deploy_job(job_id) is None:
+                return ran
+        except Exception:
+            logger.exception("Deploy job %s failed", job_id)
+        ran.append(job_id)
+
+
+def recover_deploy_jobs():
+    """Fail the jobs that a stopped process left running, then run the pending ones
+
+    Called when a process that runs the jobs starts. Returns the ids of the
+    jobs that ran.
+    """
+    holder = "recovery {0}".format(os.getpid())
+    if acquire_shaping_lock(holder):
+        try:
+            _fail_orphaned_jobs()
+        finally:
+            release_shaping_lock(holder)
+    return run_pending_jobs()
+
+
+def start_deploy_queue():
+    """Recover the jobs of the "thread" backend in the local worker pool"""
+    if getattr(settings, 'DEPLOY_QUEUE_BACKEND', 'thread') == 'thread':
+        pool.submit(recover_deploy_jobs)
+
+
+def _run_job(job, deploy, *args):
+    """Run the deploy function of a claimed job, then record its outcome and notify
+
+    `deploy` is called with the job, the progress and the status dicts that
+    it fills in and `args`, and returns the DeployResult of its play. A job
+    that raises is marked as failed. The outcome is written to the audit log
+    and the summary notification is sent whatever the outcome. Returns the
+    status code of every host.
+    """
+    progress = {}
+    status = {}
+    result = None
+    error = None
+    try:
+        result = deploy(job, progress, status, *args)
+    except Exception as e:
+        error = e
+        job.status = DeployJob.FAILED
+        for host, host_progress in progress.items():
+            if host_progress == "pending":
+                status[host] = TaskQueueManager.RUN_FAILED_HOSTS
+        raise
+    else:
+        job.status = DeployJob.FINISHED
+    finally:
+        for host, host_progress in progress.items():
+            if host_progress == "pending":
+                progress[host] = HOST_STATUS.get(status.get(host), "failed")
+        job.progress = json.dumps(progress)
+        job.finished = timezone.now()
+        job.save(update_fields=['status', 'progress', 'finished'])
+        failed = [host for host, host_status in status.items() if host_status != TaskQueueManager.RUN_OK]
+        audit_sink.log("{0} {1}: {2} of {3} hosts failed".format(
+            job, job.get_status_display().lower(), len(failed), len(status)),
+            status="failed" if failed or error is not None else "ok", user=job.user)
+        audit_sink.flush()
+        notify_deploy_job(job, status, result, error=error)
+    return status
+
+
+def _deploy_job_rules(job, progress, status):
+    """Deploy the rules of a job and update the rules and the rule groups
+
+    `progress` and `status` are filled in with the state of every host as
+    the job goes. Returns the DeployResult of the play, if one ran.
+    """
+    rule_groups = list(job.rule_groups.prefetch_related('rule__host'))
+    group_rules = [(rule_group, list(rule_group.rule.all())) for rule_group in rule_groups]
+    job_rules = dict((rule.id, rule) for rule_group, rules in group_rules for rule in rules)
+    other_rules = Rule.objects.filter(
+        is_deployed=True, host__rule__rulegroup__in=rule_groups).exclude(
+        rulegroup__in=rule_groups).distinct()
+    hosts = set(rule.host for rule in job_rules.values())
+    desired_rules = list(other_rules)
+    if not job.is_undeploy:
+        desired_rules.extend(job_rules.values())
+    plan = ShapingPlan(hosts, desired_rules)
+    # Hosts verified to be up to date are skipped, drifted ones are rebuilt
+    plan.use_snapshots(verify_plan(plan))
+    result = _deploy_plan(job, plan, progress, status)
+
+    for rule_group, rules in group_rules:
+        message = []
+        deployed_rules = []
+        for rule in rules:
+            if status.get(rule.host.name) == 0:
+                deployed_rules.append(rule.id)
+                message.append("deployed")
+            else:
+                message.append("failed")
+        if rules:
+            rule_group.is_deployed = "failed" not in message
+            if rule_group.is_deployed:
+                rule_group.is_active = not job.is_undeploy
+            rule_group.save()
+        if deployed_rules:
+            Rule.objects.filter(id__in=deployed_rules).update(
+                is_deployed=not job.is_undeploy)
+    return result
+
+
+def _deploy_plan(job, plan, progress, status):
+    """Deploy the commands of a ShapingPlan with a single play and record it
+
+    `progress` and `status` are filled in with the state of every host of the
+    plan as the play goes. Returns the DeployResult of the play, if one ran.
+    """
+    host_commands = plan.commands()
+    progress.update((host.name, "pending" if host.name in host_commands else "unchanged")
+                    for host in plan.hosts.values())
+    DeployJob.objects.filter(id=job.id).update(progress=json.dumps(progress))
+
+    # The progress is written at most once per interval, the job writes the
+    # final progress once it is finished
+    last_write = [time.time()]
+
+    def report(host, host_status):
+        progress[host] = HOST_STATUS.get(host_status, "failed")
+        if time.time() - last_write[0] >= PROGRESS_INTERVAL:
+            DeployJob.objects.filter(id=job.id).update(progress=json.dumps(progress))
+            refresh_shaping_lock(_lock_holder(job.id))
+            last_write[0] = time.time()
+
+    # Hosts without changes are already up to date
+    status.update((host.name, TaskQueueManager.RUN_OK) for host in plan.hosts.values())
+    result = None
+    if host_commands:
+        host_options = get_inventory().host_options()
+        result = AnsibleDeploy(options=host_options).deploy_batch(
+            host_commands, facts='no', progress=report)
+        status.update(result.status)
+    plan.record(status)
+    return result
+
+
+def _excerpt(text):
+    text = " ".join(text.split())
+    if len(text) > NOTIFICATION_EXCERPT:
+        return text[:NOTIFICATION_EXCERPT] + "..."
+    return text
+
+
+def summarize_deploy(status, result=None, error=None):
+    """Describe the outcome of a deploy for a notification
+
+    `status` maps the host names to their TaskQueueManager status code and
+    `result` is the DeployResult of the play, if one ran. `error` is the
+    exception that aborted the deploy, if any. The failed hosts come first,
+    followed by the successful hosts that wrote to stderr, each with an
+    excerpt of its error output. Returns the verb and the description.
+    """
+    failed = sorted(host for host, host_status in status.items() if host_status != TaskQueueManager.RUN_OK)
+    warned = sorted(host for host in (result.tasks if result is not None else ())
+                    if host not in failed and result.stderr(host))
+    if failed or error is not None:
+        verb = "failed"
+    elif warned:
+        verb = "rules_failed"
+    else:
+        return "deployed", "{0} hosts deployed".format(len(status))
+
+    lines = []
+    if error is not None:
+        lines.append("The deploy was aborted: {0}".format(_excerpt(repr(error))))
+    if status:
+        lines.append("{0} of {1} hosts failed, {2} more wrote to stderr".format(
+            len(failed), len(status), len(warned)))
+    listed = failed + warned
+    for host in listed[:NOTIFICATION_HOSTS]:
+        stderr = result.stderr(host) if result is not None else ""
+        lines.append("{0} ({1}): {2}".format(
+            host, HOST_STATUS.get(status.get(host), "failed"), _excerpt(stderr) or "no output"))
+    if len(listed) > NOTIFICATION_HOSTS:
+        lines.append("and {0} more hosts".format(len(listed) - NOTIFICATION_HOSTS))
+    return verb, "\n".join(lines)
+
+
+def notify_deploy_job(job, status, result=None, error=None):
+    """Send a single summary notification of a deploy job to every recipient
+
+    The user of the job is always notified, the superusers only when the job
+    failed or hosts wrote to stderr. The notifications are written with a
+    single insert. Returns the notifications.
+    """
+    verb, description = summarize_deploy(status, result, error)
+    if verb == "deployed":
+        recipients = [job.user] if job.user is not None else []
+    else:
+        recipients = list(User.objects.filter(Q(is_superuser=True) | Q(id=job.user_id)))
+    user_type = ContentType.objects.get_for_model(User)
+    job_type = ContentType.objects.get_for_model(DeployJob)
+    notifications = [Notification(
+        recipient=recipient, actor_content_type=user_type,
+        actor_object_id=str((job.user or recipient).pk), verb=verb, description=description,
+        level="success" if verb == "deployed" else "error",
+        target_content_type=job_type, target_object_id=str(job.id)) for recipient in recipients]
+    Notification.objects.bulk_create(notifications)
+    return notifications
+
+
+def delete_rules(rule_ids):
+    """Delete rules with a single statement
+
+    Returns the interfaces of the deleted rules keyed by host id, the ones
+    whose shaping has to be torn down and reapplied.
+    """
+    rules = Rule.objects.filter(id__in=rule_ids)
+    teardown = defaultdict(set)
+    for host_id, interface in rules.filter(host__isnull=False).values_list('host_id', 'interface'):
+        teardown[host_id].add(interface)
+    rules.delete()
+    return dict((host_id, sorted(interfaces)) for host_id, interfaces in teardown.items())
+
+
+def enqueue_rule_deletion(user, rule_ids):
+    """Delete rules and queue the reapply of the shaping of their hosts
+
+    The reapply is a DeployJob that goes through the same queue as the
+    deploys. Returns the job, or None when no host had any of the rules.
+    """
+    teardown = delete_rules(rule_ids)
+    if not teardown:
+        return None
+    job = DeployJob.objects.create(user=user, is_undeploy=True, teardown=json.dumps(teardown))
+    return _queue_job(job)
+
+
+def _reapply_hosts(job, progress, status, teardown):
+    """Reapply the shaping of the hosts that rules were deleted from
+
+    `teardown` maps host ids to the interfaces of the deleted rules. Every
+    host has those interfaces torn down and its remaining deployed rules
+    compiled together and set again. The hosts share a single play, so they
+    are handled in parallel.
+    """
+    hosts = list(Host.objects.filter(id__in=list(teardown)))
+    plan = ShapingPlan(hosts, Rule.objects.filter(host__in=hosts, is_deployed=True),
+                       teardown=teardown)
+    return _deploy_plan(job, plan, progress, status)
+
+
+def enqueue_snapshot_collection(host_ids):
+    """Collect the shaping snapshots of the hosts in the background"""
+    pool.submit(collect_host_snapshots, list(host_ids))
+
+
+def collect_host_snapshots(host_ids):
+    """Collect the shaping snapshots of the hosts with a single play"""
+    return collect_snapshots(Host.objects.filter(id__in=host_ids))
+
+
+def enqueue_topology_map_push(changed_only=None):
+    """Push the topology map to the hosts in the background"""
+    if changed_only is None:
+        changed_only = getattr(settings, 'TOPOLOGY_MAP_PUSH', 'all') == 'changed'
+    pool.submit(push_topology_map, changed_only)
+
+
+def push_topology_map(changed_only=False):
+    """Copy the topology map to the hosts with a single play
+
+    Nothing is pushed when the map is identical to the last pushed one. With
+    `changed_only` only the hosts whose region changed receive the map.
+    Returns the status of every host that the map was pushed to.
+    """
+    update = TopologyMapUpdate(TopologyMap.objects.order_by('-id').first())
+    if not update.is_changed:
+        return {}
+    inventory = get_inventory()
+    hosts = sorted(inventory.hosts_vars)
+    if changed_only and update.last_map is not None:
+        changed_hosts = set(update.changed_hosts())
+        hosts = [host for host in hosts if host in changed_hosts]
+    status = {}
+    if hosts:
+        status = AnsibleDeploy(options=inventory.host_options()).copy_batch(
+            hosts, update.content, TOPOLOGY_MAP_PATH).status
+    if all(host_status == TaskQueueManager.RUN_OK for host_status in status.values()):
+        TopologyMap.objects.create(checksum=update.checksum,
+                                   host_regions=json.dumps(update.host_regions))
+    return status
@@ -1,3 +1,672 @@
-from django.test import TestCase
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from control_panel import deploy
+from control_panel.audit import AuditFlushMiddleware, AuditSink, audit_sink
+from control_panel.benchmark import FakeTaskQueueManager, fake_ansible, write_inventory
+from control_panel.compiler import RuleCompiler, aggregate_tcsets, compile_rules
+from control_panel.deploy import DeployResult, TaskResult
+from control_panel.facts import UPDATE_BATCH_SIZE, host_facts, save_host_facts
+from control_panel.mesh import build_full_mesh, bulk_batch_size, mesh_rule
+from control_panel.models import (Audit, DeployJob, Host, InstanceType, Region, Rule, RuleGroup, ShapingLock,
+                                  ShapingSnapshot, ShapingState, TopologyMap, WAN, ip_key, ip_key_range)
+from control_panel.paths import get_path_costs
+from control_panel.shaping import ShapingPlan, shaping_key
+from control_panel.tasks import (SHAPING_LOCK_TIMEOUT, acquire_shaping_lock, delete_rules, enqueue_rule_deletion,
+                                 notify_deploy_job, push_topology_map, recover_deploy_jobs, release_shaping_lock,
+                                 run_deploy_job, run_pending_jobs, summarize_deploy)
+from control_panel.verify import verify_plan
+
+from ansible.executor.task_queue_manager import TaskQueueManager
+
+from notifications.models import Notification
+
+import csv
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from unittest import skipUnless
+
+
+class ShapingTestCase(TestCase):
+    """Two regions linked by a WAN, with a host per region and one more in the first"""
+
+    def setUp(self):
+        self.region_a = Region.objects.create(
+            name="a", internal_max_bandwidth=1000, internal_bw_rate=2, internal_latency=2,
+            external_max_bandwidth=500, external_bw_rate=2)
+        self.region_b = Region.objects.create(
+            name="b", internal_max_bandwidth=1000, internal_bw_rate=2, internal_latency=3,
+            external_max_bandwidth=200, external_bw_rate=2)
+        WAN.objects.create(name="b_a", bandwidth=1, bw_rate=3, latency=20)
+        instance_type = InstanceType.objects.create(name="t", bandwidth=100, bw_rate=2, latency=1)
+        self.host = Host.objects.create(name="h1", region=self.region_a, instance_type=instance_type,
+                                        interface="eth0", ip_address="10.0.0.1")
+        self.neighbour = Host.objects.create(name="h2", region=self.region_a, instance_type=instance_type,
+                                             interface="eth0", ip_address="10.0.0.2")
+        self.remote = Host.objects.create(name="h3", region=self.region_b, instance_type=instance_type,
+                                          interface="eth0", ip_address="10.0.1.3")
+
+    def rule(self, target_host, **kwargs):
+        kwargs.setdefault('latency', 10)
+        return Rule.objects.create(host=self.host, interface="eth0", target_host=target_host,
+                                   latency_time_unit=1, **kwargs)
+
+
+class FailingTaskQueueManager(FakeTaskQueueManager):
+    """The fake executor of the benchmark, the tasks of `failed_hosts` fail"""
+
+    failed_hosts = set()
+
+    def _send_callback(self, method_name, *args):
+        if method_name == 'v2_runner_on_ok' and args[0]._host.get_name() in self.failed_hosts:
+            args[0]._result.update(failed=True, rc=2, stderr="RTNETLINK answers: File exists")
+            method_name = 'v2_runner_on_failed'
+        FakeTaskQueueManager._send_callback(self, method_name, *args)
+
+    def run(self, play):
+        exit_code = FakeTaskQueueManager.run(self, play)
+        if self.failed_hosts & set(play.data['hosts']):
+            return self.RUN_FAILED_HOSTS
+        return exit_code
+
+
+class AnsibleTestCase(ShapingTestCase):
+    """Runs the plays with the fake executor against an inventory of the hosts"""
+
+    def setUp(self):
+        super(AnsibleTestCase, self).setUp()
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        overridden = self.settings(ANSIBLE_INVENTORY=os.path.join(work_dir, "hosts"),
+                                   FACT_CACHE_DIR=os.path.join(work_dir, "fact_cache"))
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        write_inventory(settings.ANSIBLE_INVENTORY)
+        executor = fake_ansible()
+        executor.__enter__()
+        self.addCleanup(executor.__exit__, None, None, None)
+        deploy.TaskQueueManager = self.executor = FailingTaskQueueManager
+        FailingTaskQueueManager.failed_hosts = set()
+
+
+class RuleCompilerTests(ShapingTestCase):
+    """The compiled commands are the ones that generate_tc_command produced"""
+
+    def test_same_region(self):
+        rule = self.rule(self.neighbour, bandwidth=50, bw_rate=2, packet_loss=1)
+        self.assertEqual(
+            RuleCompiler([rule]).command(rule),
+            "tcset --rate 50Mbps --delay 13milliseconds --device eth0 --loss 1 "
+            "--dst-network 10.0.0.2 --direction outgoing --change; "
+            "tcset --rate 50Mbps --delay 13milliseconds --device eth0 --loss 1 "
+            "--dst-network 10.0.0.2 --direction incoming --change;")
+
+    def test_other_region(self):
+        rule = self.rule(self.remote, latency=5, port_number=8080)
+        self.assertEqual(
+            RuleCompiler([rule]).command(rule),
+            "tcset --rate 100Mbps --delay 31milliseconds --device eth0 --port 8080 "
+            "--dst-network 10.0.1.3 --direction outgoing --change; "
+            "tcset --rate 100Mbps --delay 31milliseconds --device eth0 --port 8080 "
+            "--dst-network 10.0.1.3 --direction incoming --change;")
+
+    def test_path_loss(self):
+        self.region_a.packet_loss = 1
+        self.region_a.packet_corruption_rate = 0.5
+        self.region_a.save()
+        WAN.objects.filter(name="b_a").update(packet_loss=2)
+        rule = self.rule(self.remote, packet_loss=1)
+        tcsets = RuleCompiler([rule]).tcset_settings(rule)
+        self.assertEqual([(tcset['loss'], tcset['corrupt']) for tcset in tcsets], [(4, 0.5), (4, 0.5)])
+
+    def test_missing_wan(self):
+        WAN.objects.all().delete()
+        with self.assertRaises(WAN.DoesNotExist):
+            get_path_costs().path(self.region_a.id, self.region_b.id)
+
+    def test_deactivate(self):
+        rule = self.rule(self.neighbour)
+        self.assertEqual(compile_rules([rule], deactivate=True), {rule.id: "tcdel --device eth0 --all"})
+
+
+class ShapingPlanTests(ShapingTestCase):
+
+    def plan(self, rules, **kwargs):
+        return ShapingPlan([self.host], rules, mode='commands', aggregate=False, **kwargs)
+
+    def deploy(self, rules, status=TaskQueueManager.RUN_OK, **kwargs):
+        plan = self.plan(rules, **kwargs)
+        commands = plan.commands()
+        plan.record({self.host.name: status})
+        return commands.get(self.host.name, "")
+
+    def test_add(self):
+        rule = self.rule(self.neighbour)
+        self.assertEqual(self.deploy([rule]), "set -e; " + RuleCompiler([rule]).command(rule))
+        state = ShapingState.objects.get(host=self.host, interface="eth0")
+        self.assertEqual(len(json.loads(state.fingerprints)), 2)
+        self.assertEqual(len(json.loads(state.tcsets)), 2)
+
+    def test_unchanged(self):
+        rule = self.rule(self.neighbour)
+        self.deploy([rule])
+        self.assertEqual(self.plan([rule]).commands(), {})
+
+    def test_change(self):
+        rule = self.rule(self.neighbour)
+        self.deploy([rule])
+        rule.latency = 50
+        rule.save()
+        commands = self.deploy([rule])
+        self.assertEqual(commands.count("tcset "), 2)
+        self.assertIn("--delay 53milliseconds", commands)
+        self.assertNotIn("tcdel", commands)
+        self.assertEqual(self.plan([rule]).commands(), {})
+
+    def test_remove(self):
+        kept = self.rule(self.remote)
+        removed = self.rule(self.neighbour)
+        self.deploy([kept, removed])
+        commands = self.deploy([kept])
+        self.assertEqual(sorted(command.strip() for command in commands.split(";") if command.strip()), [
+            "set -e",
+            "tcdel --device eth0 --direction incoming --dst-network 10.0.0.2 || true",
+            "tcdel --device eth0 --direction outgoing --dst-network 10.0.0.2 || true"])
+        self.assertEqual(self.plan([kept]).commands(), {})
+
+    def test_remove_all(self):
+        rule = self.rule(self.neighbour)
+        self.deploy([rule])
+        self.assertEqual(self.deploy([]).count("tcdel "), 2)
+        self.assertFalse(ShapingState.objects.exists())
+
+    def test_teardown(self):
+        rule = self.rule(self.neighbour)
+        self.deploy([rule])
+        commands = self.deploy([rule], teardown={self.host.id: {"eth1"}})
+        self.assertTrue(commands.startswith(
+            "set -e; tcdel --device eth0 --all || true; tcdel --device eth1 --all || true; "))
+        self.assertEqual(commands.count("tcset "), 2)
+
+    def test_failed_host_is_not_recorded(self):
+        rule = self.rule(self.neighbour)
+        self.deploy([rule], status=TaskQueueManager.RUN_FAILED_HOSTS)
+        self.assertFalse(ShapingState.objects.exists())
+        self.assertEqual(self.plan([rule]).commands(), {self.host.name: "set -e; " + RuleCompiler([rule]).command(rule)})
+
+    def run_commands(self, rules, failing=""):
+        """Run the commands of the host in a shell where tcdel always fails and
+        tcset fails for the destinations that match `failing`"""
+        plan = self.plan(rules)
+        bin_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bin_dir)
+        for name, script in (("tcset", 'case "$*" in *{0}*) exit 1;; esac'.format(failing or "-")),
+                             ("tcdel", "exit 1")):
+            path = os.path.join(bin_dir, name)
+            with open(path, "w") as script_file:
+                script_file.write("#!/bin/sh\n{0}\n".format(script))
+            os.chmod(path, 0o755)
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"])
+        returncode = subprocess.call(["sh", "-c", plan.commands()[self.host.name]], env=env)
+        plan.record({self.host.name: TaskQueueManager.RUN_OK if returncode == 0
+                     else TaskQueueManager.RUN_FAILED_HOSTS})
+        return returncode
+
+    def test_failed_command_fails_the_host(self):
+        rules = [self.rule(self.neighbour), self.rule(self.remote)]
+        self.assertNotEqual(self.run_commands(rules, failing="10.0.0.2"), 0)
+        self.assertFalse(ShapingState.objects.exists())
+
+    def test_missing_filter_removal_is_not_fatal(self):
+        kept = self.rule(self.remote)
+        self.deploy([kept, self.rule(self.neighbour)])
+        self.assertEqual(self.run_commands([kept]), 0)
+        self.assertEqual(self.plan([kept]).commands(), {})
+
+
+class ImportModeTests(ShapingTestCase):
+
+    def deploy(self, rules):
+        plan = ShapingPlan([self.host], rules, mode='import', aggregate=False)
+        command = plan.commands()[self.host.name]
+        plan.record({self.host.name: TaskQueueManager.RUN_OK})
+        return command
+
+    def setting(self, command):
+        return json.loads(command.split("<< 'EOF'\n", 1)[1].split("\nEOF\n", 1)[0])
+
+    def test_import(self):
+        command = self.deploy([self.rule(self.neighbour)])
+        self.assertTrue(command.startswith("tcdel --device eth0 --all || true;\n"))
+        self.assertIn('tcset --import-setting "$tc_setting"', command)
+        self.assertEqual(self.setting(command)["eth0"]["outgoing"], {
+            "dst-network=10.0.0.2/32, protocol=ip": {"delay": "13milliseconds", "rate": "100Mbps"}})
+
+    def test_reimport_clears_the_shaped_interfaces(self):
+        rule = self.rule(self.neighbour)
+        self.deploy([rule])
+        rule.latency = 50
+        rule.interface = "eth1"
+        rule.save()
+        command = self.deploy([rule])
+        self.assertTrue(command.startswith(
+            "tcdel --device eth0 --all || true;\ntcdel --device eth1 --all || true;\n"))
+        self.assertEqual(list(self.setting(command)), ["eth1"])
+        self.assertIn("53milliseconds", command)
+
+
+class MeshTests(ShapingTestCase):
+
+    def test_full_mesh(self):
+        existing = self.rule(self.neighbour)
+        rule_group = RuleGroup.objects.create(name="mesh")
+        self.assertEqual(build_full_mesh(rule_group, [self.host.id, self.neighbour.id, self.remote.id]), 6)
+        rules = rule_group.rule.all()
+        self.assertNotIn(existing, rules)
+        self.assertEqual(sorted((rule.host.name, rule.target_host.name) for rule in rules), [
+            ("h1", "h2"), ("h1", "h3"), ("h2", "h1"), ("h2", "h3"), ("h3", "h1"), ("h3", "h2")])
+        self.assertEqual(rules[0].latency, 1)
+
+    @skipUnless(connection.vendor == 'sqlite', "SQLite limits the parameters of a query")
+    def test_batch_size_fits_sqlite(self):
+        rules = [mesh_rule(self.host, self.neighbour) for i in range(100)]
+        fields = [field for field in Rule._meta.concrete_fields if field.name != 'id']
+        self.assertLessEqual(bulk_batch_size(Rule, rules, 500) * len(fields), 999)
+
+
+class AggregateTcsetsTests(TestCase):
+
+    def tcset(self, address, delay="10milliseconds"):
+        return {'rate': "1Mbps", 'delay': delay, 'device': "eth0", 'dst-network': address,
+                'direction': "outgoing"}
+
+    def test_collapse(self):
+        tcsets = [self.tcset("10.0.0.{0}".format(i)) for i in range(4)] + [self.tcset("10.0.0.9")]
+        self.assertEqual([tcset['dst-network'] for tcset in aggregate_tcsets(tcsets)],
+                         ["10.0.0.0/30", "10.0.0.9"])
+
+    def test_different_shaping_is_kept_apart(self):
+        tcsets = [self.tcset("10.0.0.0"), self.tcset("10.0.0.1", delay="20milliseconds")]
+        self.assertEqual(aggregate_tcsets(tcsets), tcsets)
+
+
+class IPKeyTests(TestCase):
+
+    def test_ipv4_key(self):
+        self.assertEqual(ip_key("10.0.0.1"), "00000000000000000000ffff0a000001")
+
+    def test_keys_sort_like_addresses(self):
+        addresses = ["::1", "9.255.255.255", "10.0.0.1", "10.0.0.10", "2001:db8::1"]
+        self.assertEqual(sorted(addresses, key=ip_key), addresses)
+
+    def test_cidr_range(self):
+        self.assertEqual(ip_key_range("10.0.0.0/24"), (ip_key("10.0.0.0"), ip_key("10.0.0.255")))
+        self.assertEqual(ip_key_range("10.0.0.7/32"), (ip_key("10.0.0.7"), ip_key("10.0.0.7")))
+
+    def test_hosts_in_cidr(self):
+        for i, address in enumerate(["10.0.0.1", "10.0.0.255", "10.0.1.0", "9.255.255.255"]):
+            Host.objects.create(name="h{0}".format(i), ip_address=address)
+        hosts = Host.objects.filter(ip_key__range=ip_key_range("10.0.0.0/24"))
+        self.assertEqual(sorted(hosts.values_list('ip_address', flat=True)), ["10.0.0.1", "10.0.0.255"])
+
+    def test_backfill(self):
+        host = Host.objects.create(name="h", ip_address="10.0.0.1")
+        Host.objects.filter(id=host.id).update(ip_key='')
+        call_command('backfill_ip_keys', stdout=StringIO())
+        self.assertEqual(Host.objects.get(id=host.id).ip_key, ip_key("10.0.0.1"))
+
+
+class TopologyMapTests(AnsibleTestCase):
+
+    def test_unchanged_map_is_not_pushed(self):
+        self.assertEqual(push_topology_map(), {"h1": 0, "h2": 0, "h3": 0})
+        self.assertEqual(push_topology_map(), {})
+        self.assertEqual(self.executor.plays, 1)
+
+    def test_changed_only(self):
+        push_topology_map()
+        self.remote.region = self.region_a
+        self.remote.save()
+        self.assertEqual(push_topology_map(changed_only=True), {"h3": 0})
+
+    def test_failed_push_is_retried(self):
+        self.executor.failed_hosts = {"h2"}
+        self.assertEqual(push_topology_map()["h2"], TaskQueueManager.RUN_FAILED_HOSTS)
+        self.assertFalse(TopologyMap.objects.exists())
+        self.executor.failed_hosts = set()
+        self.assertEqual(len(push_topology_map()), 3)
+
+
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user("admin", password="admin")
+        self.client.force_login(user)
+        Audit.objects.bulk_create([Audit(log="log {0}".format(i)) for i in range(150)])
+
+    def test_pages(self):
+        response = self.client.get("/history/")
+        self.assertEqual(len(response.context["history"]), 100)
+        response = self.client.get("/history/", {"before": response.context["next_page"]})
+        self.assertEqual(len(response.context["history"]), 50)
+        self.assertIsNone(response.context["next_page"])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get("/history/", {"before": "abc"}).status_code, 404)
+        self.assertEqual(self.client.get("/history/", {"before": "999999"}).status_code, 404)
+
+    def test_export_csv(self):
+        response = self.client.get("/history/export/")
+        rows = list(csv.reader(b"".join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(rows[0], ["timestamp", "user", "status", "log"])
+        self.assertEqual(len(rows), 151)
+        self.assertEqual(rows[1][3], "log 0")
+
+
+class AuditSinkTests(TestCase):
+
+    def test_buffer_is_written_when_full(self):
+        sink = AuditSink(max_size=3, max_age=60)
+        sink.log("a")
+        sink.log("b")
+        self.assertFalse(Audit.objects.exists())
+        sink.log("c")
+        self.assertEqual(sorted(Audit.objects.values_list('log', flat=True)), ["a", "b", "c"])
+
+    def test_buffer_is_written_when_old(self):
+        sink = AuditSink(max_size=100, max_age=0)
+        sink.log("a")
+        self.assertEqual(Audit.objects.count(), 1)
+
+    def test_long_log_is_truncated(self):
+        sink = AuditSink()
+        sink.log("x" * 1000)
+        sink.flush()
+        log = Audit.objects.get().log
+        self.assertEqual(len(log), Audit._meta.get_field('log').max_length)
+        self.assertTrue(log.endswith("..."))
+
+    def test_middleware_flushes_failed_requests(self):
+        def view(request):
+            audit_sink.log("request")
+            raise ValueError("view failed")
+
+        with self.assertRaises(ValueError):
+            AuditFlushMiddleware(view)(RequestFactory().get("/"))
+        self.assertEqual(Audit.objects.get().log, "request")
+
+
+class SaveHostFactsTests(TestCase):
+
+    def entry(self, i, cores=4, groups=("web",)):
+        return host_facts({
+            'ansible_fqdn': "host{0}".format(i),
+            'ansible_default_ipv4': {'address': "10.0.{0}.{1}".format(i // 250, i % 250 + 1)},
+            'ansible_processor_cores': cores,
+            'ansible_memory_mb': {'real': {'total': 1024 * (i + 1)}},
+            'ansible_lsb': {'description': "Ubuntu 16.04.2 LTS"},
+            'ansible_kernel': "4.4.0-78-generic",
+        }, groups)
+
+    def test_insert(self):
+        save_host_facts([self.entry(0), self.entry(1, groups=("web", "db"))])
+        host = Host.objects.get(name="host1")
+        self.assertEqual((host.ip_address, host.ip_key, host.memory), ("10.0.0.2", ip_key("10.0.0.2"), "2048MB"))
+        self.assertIsNone(host.region)
+        self.assertEqual(sorted(host.inventory_groups.values_list('name', flat=True)), ["db", "web"])
+
+    def test_update_across_batches(self):
+        count = UPDATE_BATCH_SIZE + 10
+        save_host_facts([self.entry(i) for i in range(count)])
+        save_host_facts([self.entry(i, cores=i) for i in range(count)])
+        self.assertEqual(dict(Host.objects.values_list('name', 'cpu')),
+                         dict(("host{0}".format(i), str(i)) for i in range(count)))
+        self.assertEqual(Host.objects.get(name="host59").memory, "61440MB")
+
+    def test_unchanged_hosts_are_not_written(self):
+        entries = [self.entry(i) for i in range(3)]
+        save_host_facts(entries)
+        with CaptureQueriesContext(connection) as queries:
+            save_host_facts(entries)
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith(("UPDATE", "INSERT"))])
+        self.assertEqual(Host.inventory_groups.through.objects.count(), 3)
+
+
+class SummarizeDeployTests(TestCase):
+
+    def test_deployed(self):
+        self.assertEqual(summarize_deploy({"a": TaskQueueManager.RUN_OK}), ("deployed", "1 hosts deployed"))
+
+    def test_failed(self):
+        result = DeployResult(["a", "b", "c"])
+        result.add("a", TaskResult("shell", TaskQueueManager.RUN_OK, 0, 0.1, "", "warning"))
+        result.add("b", TaskResult("shell", TaskQueueManager.RUN_FAILED_HOSTS, 2, 0.1, "", "RTNETLINK error"))
+        verb, description = summarize_deploy(result.status, result)
+        self.assertEqual(verb, "failed")
+        self.assertEqual(description.splitlines(), [
+            "2 of 3 hosts failed, 1 more wrote to stderr",
+            "b (failed): RTNETLINK error",
+            "c (failed): no output",
+            "a (deployed): warning"])
+
+    def test_stderr_only(self):
+        result = DeployResult(["a"])
+        result.add("a", TaskResult("shell", TaskQueueManager.RUN_OK, 0, 0.1, "", "warning"))
+        self.assertEqual(summarize_deploy(result.status, result)[0], "rules_failed")
+
+    def test_aborted(self):
+        verb, description = summarize_deploy({}, error=KeyError("region"))
+        self.assertEqual(verb, "failed")
+        self.assertIn("KeyError", description)
+
+    def test_recipients(self):
+        user = User.objects.create_user("user")
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        job = DeployJob.objects.create(user=user)
+        notify_deploy_job(job, {"a": TaskQueueManager.RUN_OK})
+        notify_deploy_job(job, {"a": TaskQueueManager.RUN_FAILED_HOSTS})
+        self.assertEqual(sorted(Notification.objects.values_list('recipient__username', 'verb')), [
+            ("admin", "failed"), ("user", "deployed"), ("user", "failed")])
+
+
+class VerifyPlanTests(ShapingTestCase):
+
+    def setUp(self):
+        super(VerifyPlanTests, self).setUp()
+        self.rules = [self.rule(self.neighbour)]
+
+    def plan(self):
+        return ShapingPlan([self.host], self.rules, mode='commands', aggregate=False)
+
+    def snapshot(self, delay="13.0ms", collected=None, **extra_filters):
+        params = {"delay": delay, "rate": "100000Kbps", "burst": "1600b"}
+        filters = {"protocol=ip, dst-network=10.0.0.2": params}
+        filters.update(extra_filters)
+        ShapingSnapshot.objects.create(
+            host=self.host, status=TaskQueueManager.RUN_OK, collected=collected or timezone.now(),
+            settings=json.dumps({"eth0": {"outgoing": filters, "incoming": {
+                "dst-network=10.0.0.2/32, protocol=ip": params}}}))
+
+    def test_units_and_networks_are_normalized(self):
+        self.snapshot()
+        report = verify_plan(self.plan())[self.host.id]
+        self.assertEqual((report["status"], report["stale"]), ("in_sync", False))
+
+    def test_drift(self):
+        self.snapshot(delay="20ms", **{"dst-network=10.0.1.0/24, protocol=ip": {"delay": "1ms"}})
+        report = verify_plan(self.plan())[self.host.id]
+        self.assertEqual(report["status"], "drift")
+        self.assertEqual(report["changed"], ["eth0 incoming dst-network=10.0.0.2/32, protocol=ip",
+                                             "eth0 outgoing dst-network=10.0.0.2/32, protocol=ip"])
+        self.assertEqual(report["unexpected"], ["eth0 outgoing dst-network=10.0.1.0/24, protocol=ip"])
+        self.assertEqual(report["missing"], [])
+
+    def test_missing_and_stale_snapshots(self):
+        self.assertEqual(verify_plan(self.plan())[self.host.id]["status"], "unknown")
+        self.snapshot(collected=timezone.now() - timedelta(days=1))
+        self.assertTrue(verify_plan(self.plan())[self.host.id]["stale"])
+
+    def test_in_sync_host_is_skipped(self):
+        self.snapshot()
+        plan = self.plan()
+        plan.use_snapshots(verify_plan(plan))
+        self.assertEqual(plan.commands(), {})
+        plan.record({})
+        self.assertEqual(self.plan().commands(), {})
+
+    def test_drifted_host_is_rebuilt(self):
+        plan = self.plan()
+        plan.record({self.host.name: TaskQueueManager.RUN_OK})
+        self.snapshot(delay="20ms")
+        plan = self.plan()
+        plan.use_snapshots(verify_plan(plan))
+        self.assertTrue(plan.commands()[self.host.name].startswith("set -e; tcdel --device eth0 --all"))
+
+
+class DeployJobTests(AnsibleTestCase):
+
+    def setUp(self):
+        super(DeployJobTests, self).setUp()
+        self.user = User.objects.create_user("user")
+        self.rule_group = RuleGroup.objects.create(name="group")
+        self.rule_group.rule.add(
+            self.rule(self.neighbour),
+            Rule.objects.create(host=self.neighbour, interface="eth0", target_host=self.host, latency=1,
+                                latency_time_unit=1),
+            Rule.objects.create(host=self.remote, interface="eth0", target_host=self.host, latency=1,
+                                latency_time_unit=1))
+
+    def run_job(self, is_undeploy=False):
+        job = DeployJob.objects.create(user=self.user, is_undeploy=is_undeploy)
+        job.rule_groups.add(self.rule_group)
+        status = run_deploy_job(job.id)
+        return DeployJob.objects.get(id=job.id), status
+
+    def test_deploy(self):
+        job, status = self.run_job()
+        self.assertEqual(job.status, DeployJob.FINISHED)
+        self.assertEqual(json.loads(job.progress), {"h1": "deployed", "h2": "deployed", "h3": "deployed"})
+        self.assertTrue(all(Rule.objects.values_list('is_deployed', flat=True)))
+        self.rule_group.refresh_from_db()
+        self.assertTrue(self.rule_group.is_deployed and self.rule_group.is_active)
+        self.assertEqual(ShapingState.objects.count(), 3)
+        self.assertEqual(Notification.objects.get().verb, "deployed")
+
+    def test_failed_host(self):
+        self.executor.failed_hosts = {"h2"}
+        job, status = self.run_job()
+        self.assertEqual(status["h2"], TaskQueueManager.RUN_FAILED_HOSTS)
+        self.assertEqual(json.loads(job.progress), {"h1": "deployed", "h2": "failed", "h3": "deployed"})
+        self.assertEqual(dict(Rule.objects.values_list('host__name', 'is_deployed')),
+                         {"h1": True, "h2": False, "h3": True})
+        self.rule_group.refresh_from_db()
+        self.assertFalse(self.rule_group.is_deployed or self.rule_group.is_active)
+        self.assertFalse(ShapingState.objects.filter(host=self.neighbour).exists())
+        self.assertIn("finished: 1 of 3 hosts failed", Audit.objects.order_by('id').last().log)
+        self.assertEqual(Notification.objects.get().verb, "failed")
+
+    def test_undeploy(self):
+        self.run_job()
+        job, status = self.run_job(is_undeploy=True)
+        self.assertEqual(job.status, DeployJob.FINISHED)
+        self.assertFalse(any(Rule.objects.values_list('is_deployed', flat=True)))
+        self.rule_group.refresh_from_db()
+        self.assertTrue(self.rule_group.is_deployed)
+        self.assertFalse(self.rule_group.is_active)
+        self.assertFalse(ShapingState.objects.exists())
+
+    def test_aborted_job(self):
+        WAN.objects.all().delete()
+        with self.assertRaises(WAN.DoesNotExist):
+            self.run_job()
+        job = DeployJob.objects.get()
+        self.assertEqual(job.status, DeployJob.FAILED)
+        self.assertIsNotNone(job.finished)
+        self.assertEqual(Notification.objects.get().verb, "failed")
+
+    def test_progress_writes_are_throttled(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.run_job()
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if query['sql'].startswith("UPDATE") and '"progress"' in query['sql']]), 2)
+
+    def test_lock_held_by_another_job(self):
+        self.assertTrue(acquire_shaping_lock("job 0"))
+        job = DeployJob.objects.create(user=self.user)
+        job.rule_groups.add(self.rule_group)
+        self.assertIsNone(run_deploy_job(job.id))
+        self.assertEqual(DeployJob.objects.get(id=job.id).status, DeployJob.PENDING)
+        release_shaping_lock("job 0")
+        self.assertEqual(run_pending_jobs(), [job.id])
+        self.assertEqual(DeployJob.objects.get(id=job.id).status, DeployJob.FINISHED)
+
+    def test_expired_lock_is_taken_over(self):
+        self.assertTrue(acquire_shaping_lock("job 0"))
+        self.assertFalse(acquire_shaping_lock("job 1"))
+        ShapingLock.objects.update(acquired=timezone.now() - timedelta(seconds=SHAPING_LOCK_TIMEOUT + 1))
+        self.assertTrue(acquire_shaping_lock("job 1"))
+        self.assertEqual(ShapingLock.objects.get().holder, "job 1")
+
+    def test_recover(self):
+        orphan = DeployJob.objects.create(user=self.user, status=DeployJob.RUNNING)
+        jobs = [DeployJob.objects.create(user=self.user) for i in range(2)]
+        for job in jobs:
+            job.rule_groups.add(self.rule_group)
+        self.assertEqual(recover_deploy_jobs(), [job.id for job in jobs])
+        self.assertEqual(dict(DeployJob.objects.values_list('id', 'status')), {
+            orphan.id: DeployJob.FAILED, jobs[0].id: DeployJob.FINISHED, jobs[1].id: DeployJob.FINISHED})
+        self.assertEqual(ShapingLock.objects.get().holder, "")
+
+
+class RuleDeletionTests(AnsibleTestCase):
+
+    def setUp(self):
+        super(RuleDeletionTests, self).setUp()
+        self.user = User.objects.create_user("user")
+        self.kept = self.rule(self.remote, is_deployed=True)
+        self.deleted = self.rule(self.neighbour, is_deployed=True)
+        plan = ShapingPlan([self.host], [self.kept, self.deleted])
+        plan.record({self.host.name: TaskQueueManager.RUN_OK})
+
+    def test_delete_rules(self):
+        self.assertEqual(delete_rules([self.deleted.id]), {self.host.id: ["eth0"]})
+        self.assertEqual(list(Rule.objects.all()), [self.kept])
+
+    @override_settings(DEPLOY_QUEUE_BACKEND="database")
+    def test_deletion_job(self):
+        job = enqueue_rule_deletion(self.user, [self.deleted.id])
+        self.assertEqual(job.status, DeployJob.PENDING)
+        self.assertEqual(json.loads(job.teardown), {str(self.host.id): ["eth0"]})
+        self.assertEqual(run_pending_jobs(), [job.id])
+        job.refresh_from_db()
+        self.assertEqual((job.status, json.loads(job.progress)), (DeployJob.FINISHED, {"h1": "deployed"}))
+        state = ShapingState.objects.get(host=self.host)
+        self.assertEqual(sorted(json.loads(state.fingerprints)), sorted(
+            shaping_key(tcset) for tcset in RuleCompiler([self.kept]).tcset_settings(self.kept)))
+
+    @override_settings(DEPLOY_QUEUE_BACKEND="database")
+    def test_failed_deletion_job(self):
+        self.executor.failed_hosts = {"h1"}
+        job = enqueue_rule_deletion(self.user, [self.deleted.id])
+        run_pending_jobs()
+        job.refresh_from_db()
+        self.assertEqual(json.loads(job.progress), {"h1": "failed"})
+        self.assertEqual(len(json.loads(ShapingState.objects.get(host=self.host).fingerprints)), 4)
+
+    def test_rules_without_host(self):
+        rule = Rule.objects.create(interface="eth0", target_region=self.region_b, latency=1, latency_time_unit=1)
+        self.assertIsNone(enqueue_rule_deletion(self.user, [rule.id]))
+        self.assertFalse(DeployJob.objects.exists())
 
-# Create your tests here.
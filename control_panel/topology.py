@@ -0,0 +1,43 @@
+from control_panel.models import Host
+
+import hashlib
+import json
+
+
+TOPOLOGY_MAP_PATH = "/etc/hadoop/conf/topology.map"
+
+
+def render_topology_map(hosts):
+    """Render the Hadoop topology map that places every host in the rack of its region"""
+    topology_map = ["""<?xml version=\'1.0\' encoding=\'UTF-8\'?>
+<!--Autogenerated by tc-panel-->
+<topology>"""]
+    for host in hosts:
+        if host.region:
+            topology_map.append("""
+    <node name=\'{0}\' rack=\'/{1}/default-rack\'/>
+    <node name=\'{2}\' rack=\'/{1}/default-rack\'/>""".format(host, host.region.slug, host.ip_address))
+    topology_map.append("\n</topology>\n")
+    return "".join(topology_map)
+
+
+class TopologyMapUpdate(object):
+    """The rendered topology map of the current hosts compared with the last pushed one"""
+
+    def __init__(self, last_map=None):
+        hosts = list(Host.objects.select_related('region').order_by('name'))
+        self.content = render_topology_map(hosts)
+        self.checksum = hashlib.sha1(self.content.encode('utf-8')).hexdigest()
+        self.host_regions = dict((host.name, host.region.slug if host.region else None)
+                                 for host in hosts)
+        self.last_map = last_map
+        self.last_host_regions = json.loads(last_map.host_regions) if last_map else {}
+
+    @property
+    def is_changed(self):
+        return self.last_map is None or self.last_map.checksum != self.checksum
+
+    def changed_hosts(self):
+        """Returns the names of the hosts whose region changed since the last push"""
+        return sorted(name for name, region in self.host_regions.items()
+                      if self.last_host_regions.get(name) != region)
@@ -0,0 +1,206 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from control_panel.ansible_helpers import get_inventory
+from control_panel.deploy import AnsibleDeploy
+from control_panel.models import Rule, ShapingSnapshot, ShapingState
+from control_panel.shaping import ShapingPlan, tc_settings
+
+from ansible.executor.task_queue_manager import TaskQueueManager
+
+import ipaddr
+import json
+import re
+
+
+# The tcconfig parameters that the panel sets, the others are ignored
+SHAPING_PARAMS = ('delay', 'rate', 'loss', 'corrupt')
+
+UNITS = {
+    'delay': {'': 1, 'ms': 1, 'msec': 1, 'millisecond': 1, 'milliseconds': 1,
+              'us': 0.001, 'usec': 0.001, 's': 1000, 'sec': 1000},
+    'rate': {'': 1, 'k': 1, 'kbps': 1, 'kbit': 1, 'm': 1000, 'mbps': 1000, 'mbit': 1000,
+             'g': 1000000, 'gbps': 1000000, 'gbit': 1000000},
+    'loss': {'': 1, '%': 1},
+    'corrupt': {'': 1, '%': 1},
+}
+
+
+def snapshot_ttl():
+    """Returns how long a snapshot stays fresh"""
+    return timedelta(seconds=getattr(settings, 'SHAPING_SNAPSHOT_TTL', 300))
+
+
+def _normalize_value(param, value):
+    match = re.match(r"^\s*([\d.]+)\s*([a-zA-Z%]*)", str(value))
+    if not match:
+        return str(value)
+    number, unit = float(match.group(1)), match.group(2).lower()
+    if unit not in UNITS[param]:
+        return str(value)
+    return round(number * UNITS[param][unit], 3)
+
+
+def _normalize_filter(tc_filter):
+    parts = []
+    for part in tc_filter.split(","):
+        key, _, value = part.strip().partition("=")
+        if key in ('dst-network', 'src-network'):
+            value = str(ipaddr.IPNetwork(value))
+        parts.append("{0}={1}".format(key, value))
+    return ", ".join(sorted(parts))
+
+
+def normalize_settings(setting):
+    """Convert a tcconfig setting to a dict of comparable filters
+
+    The keys are (interface, direction, filter) and the values the shaping
+    parameters, with the networks and the units written the same way
+    whatever tcconfig version produced them.
+    """
+    filters = {}
+    for interface, directions in (setting or {}).items():
+        for direction, interface_filters in (directions or {}).items():
+            for tc_filter, params in (interface_filters or {}).items():
+                filters[(interface, direction, _normalize_filter(tc_filter))] = dict(
+                    (param, _normalize_value(param, value)) for param, value in params.items()
+                    if param in SHAPING_PARAMS)
+    return filters
+
+
+def drift(expected, actual):
+    """Compare the expected and the actual tcconfig settings of a host
+
+    Returns the filters that are missing, unexpected or set with other
+    parameters than expected, each as "interface direction filter".
+    """
+    expected = normalize_settings(expected)
+    actual = normalize_settings(actual)
+    label = " ".join
+    return {
+        "missing": sorted(label(key) for key in expected if key not in actual),
+        "unexpected": sorted(label(key) for key in actual if key not in expected),
+        "changed": sorted(label(key) for key in expected if key in actual and expected[key] != actual[key]),
+    }
+
+
+def host_interfaces(hosts):
+    """Returns the interfaces of every host that the panel shapes, keyed by host id"""
+    interfaces = defaultdict(set)
+    for host in hosts:
+        if host.interface:
+            interfaces[host.id].add(host.interface)
+    for model in (Rule, ShapingState):
+        for host_id, interface in model.objects.filter(
+                host__in=hosts).values_list('host_id', 'interface'):
+            interfaces[host_id].add(interface)
+    return interfaces
+
+
+def collect_snapshots(hosts):
+    """Collect the applied tcconfig settings of the hosts with a single tcshow play
+
+    The snapshots replace the previous ones of the hosts. Hosts that fail or
+    are unreachable get a snapshot without settings. Returns the snapshots.
+    """
+    hosts = list(hosts)
+    interfaces = host_interfaces(hosts)
+    commands = dict((host.name, "tcshow " + " ".join(
+        "--device " + interface for interface in sorted(interfaces[host.id])))
+        for host in hosts if interfaces[host.id])
+    host_options = get_inventory().host_options()
+    results = AnsibleDeploy(options=host_options).show_batch(commands)
+
+    now = timezone.now()
+    snapshots = []
+    for host in hosts:
+        if host.name not in results.tasks:
+            continue
+        status, output = results.host_status(host.name), results.stdout(host.name)
+        setting = None
+        if status == 0:
+            try:
+                setting = json.dumps(json.loads(output))
+            except (TypeError, ValueError):
+                status = 1
+        snapshots.append(ShapingSnapshot(host=host, status=status, settings=setting, collected=now))
+    with transaction.atomic():
+        ShapingSnapshot.objects.filter(host__in=hosts).delete()
+        ShapingSnapshot.objects.bulk_create(snapshots)
+    return snapshots
+
+
+def expected_settings(plan):
+    """Returns the tcconfig setting that every host of a ShapingPlan should have"""
+    interfaces = defaultdict(dict)
+    for (host_id, interface), tcsets in plan.desired.items():
+        if tcsets:
+            interfaces[host_id][interface] = tcsets
+    return dict((host_id, tc_settings(interfaces[host_id])) for host_id in plan.hosts)
+
+
+def applied_settings(plan):
+    """Returns the tcconfig setting that the panel applied to every host of a ShapingPlan
+
+    The setting comes from the ShapingState of the host interfaces. It is
+    None for the hosts whose states were recorded without their tcset
+    arguments, since their applied shaping is unknown.
+    """
+    interfaces = defaultdict(dict)
+    unknown = set()
+    for (host_id, interface), state in plan.applied.items():
+        tcsets = json.loads(state.tcsets)
+        if len(tcsets) != len(json.loads(state.fingerprints)):
+            unknown.add(host_id)
+        elif tcsets:
+            interfaces[host_id][interface] = tcsets
+    return dict((host_id, None if host_id in unknown else tc_settings(interfaces[host_id]))
+                for host_id in plan.hosts)
+
+
+def verify_plan(plan):
+    """Compare the fresh snapshots of the hosts of a ShapingPlan with its desired shaping
+
+    Returns a dict that maps the host ids to their report. Hosts without a
+    snapshot are "unknown" and snapshots older than SHAPING_SNAPSHOT_TTL are
+    marked as stale. `applied_status` tells whether the snapshot matches the
+    shaping that the panel last applied to the host, which differs from the
+    desired one while a deploy changes the host.
+    """
+    expected = expected_settings(plan)
+    applied = applied_settings(plan)
+    snapshots = dict((snapshot.host_id, snapshot) for snapshot in
+                     ShapingSnapshot.objects.filter(host__in=list(plan.hosts)))
+    fresh_after = timezone.now() - snapshot_ttl()
+    reports = {}
+    for host_id, host in plan.hosts.items():
+        snapshot = snapshots.get(host_id)
+        report = {"host": host.name, "collected": None, "stale": True, "status": "unknown",
+                  "applied_status": "unknown"}
+        if snapshot is not None:
+            report["collected"] = str(snapshot.collected)
+            report["stale"] = snapshot.collected < fresh_after
+            if snapshot.settings is None:
+                report["status"] = "unreachable" if snapshot.status == \
+                    TaskQueueManager.RUN_UNREACHABLE_HOSTS else "failed"
+            else:
+                actual = json.loads(snapshot.settings)
+                report.update(drift(expected[host_id], actual))
+                is_drifted = report["missing"] or report["unexpected"] or report["changed"]
+                report["status"] = "drift" if is_drifted else "in_sync"
+                if applied[host_id] is not None:
+                    report["applied_status"] = "drift" if any(
+                        drift(applied[host_id], actual).values()) else "in_sync"
+        reports[host_id] = report
+    return reports
+
+
+def verify_hosts(hosts):
+    """Compare the cached snapshots of the hosts with their deployed rules"""
+    hosts = list(hosts)
+    plan = ShapingPlan(hosts, Rule.objects.filter(host__in=hosts, is_deployed=True))
+    reports = verify_plan(plan)
+    return [reports[host.id] for host in sorted(hosts, key=lambda host: host.name)]
@@ -1,5 +1,6 @@
-from django.shortcuts import render, redirect
-from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404, render, redirect
+from django.db.models import Q
+from django.http import Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.contrib.auth.models import User, Group
 from django.contrib.auth import authenticate
 from django.contrib.auth.decorators import login_required
@@ -7,136 +8,24 @@ from django.contrib.auth import login as auth_login
 from django.contrib.auth import logout as auth_logout
 
 from control_panel.forms import AddUserGroupForm, ConfigureHostForm, AddWANForm, AddInstanceTypeForm, HostForm, ApplyRegionForm, UserForm, LoginForm, UserProfileForm, AddRegionForm, AddRuleForm, ActionsForm, AddRuleGroupForm
-from control_panel.models import InstanceType, WAN, Host, Audit, Region, Rule, RuleGroup
-from control_panel.deploy import AnsibleDeploy
-from control_panel.ansible_helpers import AnsibleInventory
-from control_panel.choices import RATE_CHOICES, TIME_CHOICES
-
-import datetime
+from control_panel.models import InstanceType, WAN, Host, Audit, DeployJob, Region, Rule, RuleGroup, ip_key_range
+from control_panel.tasks import enqueue_deploy, enqueue_rule_deletion, enqueue_snapshot_collection, enqueue_topology_map_push
+from control_panel.audit import audit_sink
+from control_panel.listing import LISTINGS, listing_values, paginate_listing
+from control_panel.mesh import build_full_mesh
+from control_panel.overview import get_overview_json, invalidate_overview
+from control_panel.verify import verify_hosts
+
+import csv
+import itertools
 import json
-import ipaddr
-import operator
 
-from notifications.signals import notify
 from notifications.models import Notification
 
 
-def _update_topology_map(hosts):
-    topology_map = ["""<?xml version=\'1.0\' encoding=\'UTF-8\'?>
-<!--Autogenerated by tc-panel-->
-<topology>""" ]
-    for host in hosts:
-        if host.region:
-            topology_map.append("""
-    <node name=\'{0}\' rack=\'/{1}/default-rack\'/>
-    <node name=\'{2}\' rack=\'/{1}/default-rack\'/>""".format(host, host.region.slug, host.ip_address))
-    topology_map.append("\n</topology>")
-    cmd = """cat > /etc/hadoop/conf/topology.map << EOF
-            {0}
-EOF""".format(" ".join(topology_map))
-    return cmd
-
-def _init_ansible(cmd, facts):
-    inventory = AnsibleInventory()
-    all_hosts = inventory.unique_hosts_data
-    global_options = inventory.global_options
-    host_options = inventory.DEFAULT_OPTIONS.copy()
-    host_options.update(global_options[0])
-    for host in all_hosts:
-        host_options.update(host["vars"])
-        status = AnsibleDeploy(options=host_options).deploy(
-            cmd, destination_host=host["name"], facts=facts)
-        # TODO: check the status
-
-
-def generate_tc_command(rule, override=False, deactivate=False):
-    """Command generation logic from UI to tcconfig commands"""
-    exclude_network = []
-    tcset_commands = []
-    final_command = []
-    if deactivate:
-        final_command.append("tcdel --device " + rule.interface + " --all")
-    else:
-        target_hosts = [rule.target_host]
-        if rule.target_host.region and (not rule.target_host):
-            target_hosts = Host.objects.filter(
-                region=rule.target_host.region).exclude(name=rule.host.name)
-        latency = 0
-        for target_host in target_hosts:
-            tcset = {}
-            # internal
-            bandwidths = [(rule.bandwidth, rule.bw_rate),
-                          (target_host.region.internal_max_bandwidth,
-                           target_host.region.internal_bw_rate),
-                          (target_host.instance_type.bandwidth,
-                           target_host.instance_type.bw_rate)]
-
-            latency = rule.latency + rule.host.instance_type.latency + \
-                rule.host.region.internal_latency
-            packet_loss = rule.packet_loss + \
-                rule.host.instance_type.packet_loss + rule.host.region.packet_loss
-            packet_corruption_rate = rule.packet_corruption_rate + \
-                rule.host.instance_type.packet_corruption_rate + \
-                rule.host.region.packet_corruption_rate
-            bandwidths = [tp for tp in bandwidths if all(tp)]
-
-            if rule.host.region != target_host.region:
-                # external
-                wan = WAN.objects.get(name="{0}_{1}".format(
-                    target_host.region.slug, rule.host.region.slug))
-                if not wan:
-                    wan = WAN.objects.get(name="{0}_{1}".format(
-                        rule.host.region.slug, target_host.region.slug))
-                    if not wan:
-                        wan = WAN.objects.get(
-                            name="{0}".format(rule.host.region.slug))
-                bandwidths = [(rule.bandwidth, rule.bw_rate),
-                              (rule.host.region.external_max_bandwidth,
-                               rule.host.region.external_bw_rate),
-                              (target_host.region.external_max_bandwidth,
-                               target_host.region.external_bw_rate),
-                              (target_host.instance_type.bandwidth,
-                               target_host.instance_type.bw_rate),
-                              (wan.bandwidth, wan.bw_rate)]
-
-                bandwidths = [tp for tp in bandwidths if all(tp)]
-                latency += target_host.region.internal_latency + wan.latency
-                packet_loss += target_host.region.packet_loss + wan.packet_loss
-                packet_corruption_rate += target_host.region.packet_corruption_rate + \
-                    wan.packet_corruption_rate
-
-            min_bandwidth, min_bandwidth_rate = min(
-                bandwidths, key=operator.itemgetter(1, 0))
-            rate_choices = dict(RATE_CHOICES)
-            time_choices = dict(TIME_CHOICES)
-            tcset['rate'] = str(int(min_bandwidth)) + \
-                    str(rate_choices[min_bandwidth_rate])
-            tcset['delay'] = str(int(latency)) + \
-                    str(time_choices[rule.latency_time_unit])
-            tcset['device'] = rule.interface
-            tcset['loss'] = int(rule.packet_loss or 0)
-            tcset['corrupt'] = rule.packet_corruption_rate
-            tcset['port'] = rule.port_number
-            tcset['src-port'] = rule.src_port_number
-            tcset['dst-network'] = rule.target_ip_address or target_host.ip_address
-            tcset['direction'] = rule.traffic_type
-
-            if not rule.traffic_type:
-                tcset['direction'] = 'outgoing'
-                tcset_commands.append(tcset)
-                shallow_copy_tcset = tcset.copy()
-                shallow_copy_tcset['direction'] = 'incoming'
-                tcset_commands.append(shallow_copy_tcset)
-
-        for cmd in tcset_commands:
-            construct_cmd = []
-            for key, value in cmd.items():
-                if value:
-                    construct_cmd.append("--" + key + " " + str(value))
-            final_command.append(
-                "tcset " + " ".join(construct_cmd) + " --change;")
-
-    return " ".join(final_command)
+HISTORY_PAGE_SIZE = 100
+
+NOTIFICATIONS_PAGE_SIZE = 100
 
 
 def index(request):
@@ -149,38 +38,65 @@ def index(request):
 @login_required
 def overview(request):
     """Overview of the emulation"""
-    rule_group = RuleGroup.objects.all()
-    nodes = []
-    edges = []
-    regions = set()
-    for tc in rule_group:
-        for rule in tc.rule.all():
-            regions.add(rule.host.region)
-        counter = 0
-        hosts = set()
-        for region in regions:
-            tc_counter = counter
-            hosts = set()
-            nodes.append({'id': tc_counter, 'label': str(region)})
-            for rule in tc.rule.all():
-                if rule.host.region == region and rule.host not in hosts:
-                    hosts.add(rule.host)
-                    counter += 1
-                    rule_counter = counter
-                    nodes.append({'id': rule_counter, 'label': str(
-                        rule.host.ip_address), 'group': str(region)})
-                    edges.append(
-                        {'from': tc_counter, 'to': rule_counter, 'length': str(200), 'label': 'TODO'})
-            counter += 1
-    return render(request, "birdseye.html", {"edges": edges, "nodes": nodes})
+    if request.is_ajax():
+        return HttpResponse(get_overview_json(), content_type="application/json")
+    return render(request, "birdseye.html", {"overview": get_overview_json()})
+
+
+def _verification_response(request, hosts):
+    """Return the cached verification reports of the hosts as JSON
+
+    A POST also queues the collection of new snapshots of the hosts.
+    """
+    hosts = list(hosts)
+    if request.method == 'POST':
+        enqueue_snapshot_collection([host.id for host in hosts])
+    reports = verify_hosts(hosts)
+    data = {
+        "in_sync": bool(reports) and all(report["status"] == "in_sync" for report in reports),
+        "refreshing": request.method == 'POST',
+        "hosts": reports,
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+@login_required
+def verify_host(request, host_name):
+    """Report whether the live shaping of a host matches its deployed rules"""
+    return _verification_response(request, Host.objects.filter(name=host_name))
+
+
+@login_required
+def verify_rule_group(request, rule_group_name):
+    """Report whether the live shaping of the hosts of a deployment group matches their deployed rules"""
+    return _verification_response(request, Host.objects.filter(
+        rule__rulegroup__name=rule_group_name).distinct())
+
+
+def _unread_notifications(request):
+    """Returns a page of the unread notifications of the user, newest first
+
+    The pages are keyset paginated like the history: `before` is the id of
+    the last notification of the previous page. Returns the notifications and
+    the id to continue from, if there are more.
+    """
+    messages = request.user.notifications.unread().prefetch_related(
+        'actor', 'target').order_by('-timestamp', '-id')
+    before = request.GET.get('before')
+    if before:
+        last = _page_cursor(request.user.notifications.all(), before)
+        messages = messages.filter(Q(timestamp__lt=last.timestamp) | Q(
+            timestamp=last.timestamp, id__lt=last.id))
+    messages = list(messages[:NOTIFICATIONS_PAGE_SIZE + 1])
+    next_page = messages[NOTIFICATIONS_PAGE_SIZE - 1].id if len(messages) > NOTIFICATIONS_PAGE_SIZE else None
+    return messages[:NOTIFICATIONS_PAGE_SIZE], next_page
 
 
 @login_required
 def view_notifications(request):
     """View notifications"""
-    user = User.objects.get(username=request.user.username)
-    messages = user.notifications.unread()
-    return render(request, "notifications.html", {"messages": messages})
+    messages, next_page = _unread_notifications(request)
+    return render(request, "notifications.html", {"messages": messages, "next_page": next_page})
 
 
 @login_required
@@ -218,9 +134,8 @@ def groups(request):
 @login_required
 def messages(request):
     """The messages view that shows all the received messages from other peers """
-    user = User.objects.get(username=request.user.username)
-    messages = user.notifications.unread()  # get the unread messages
-    return render(request, "connect/messages.html", {'messages': messages})
+    messages, next_page = _unread_notifications(request)
+    return render(request, "connect/messages.html", {'messages': messages, 'next_page': next_page})
 
 
 @login_required
@@ -236,65 +151,41 @@ def dismiss_message(request):
 
 @login_required
 def deploy(request, selected_rule_groups):
-    """Trigger Ansible and deploy commands via Ansible"""
-    is_deploy = True if 'deploy' in request.POST else False
-    is_undeploy = True if 'undeploy' in request.POST else False
-    for rule_group_id in selected_rule_groups:
-        rule_group = RuleGroup.objects.get(id=rule_group_id)
-        message = []
-        for rule in rule_group.rule.all():
-            if rule.is_deployed:
-                continue
-            command = ""
-            if is_deploy: command = generate_tc_command(rule)
-            elif is_undeploy: command = generate_tc_command(rule, deactivate=True)
-
-            if not command:  # if there are no args or rules to play with
-                continue
-
-            inventory = AnsibleInventory()
-            hosts = inventory.unique_hosts_data
-            global_options = inventory.global_options
-            host_options = inventory.DEFAULT_OPTIONS.copy()
-            host_options.update(global_options[0])
-            host_vars = [host["vars"]
-                            for host in hosts if host["name"] == rule.host.name]
-            host_options.update(host_vars[0])
-            status = AnsibleDeploy(options=host_options).deploy(
-                command, rule.host.name, facts='no')
-
-            if status == 0:
-                rule_group.is_deployed = True
-                if is_deploy:
-                    rule.is_deployed = True
-                    rule_group.is_active = True
-                elif is_undeploy:
-                    rule_group.is_active = False
-                message.append("deployed")
-            else:
-                rule_group.is_deployed = False
-                message.append("failed")
-            rule_group.save()
-        verb = "failed" if "failed" in message else "deployed"
-        recipient = User.objects.get(username=request.user.username)
-        notify.send(request.user, recipient=recipient, verb=verb)
+    """Queue the deployment of the rule groups, Ansible runs in the background"""
+    is_undeploy = 'undeploy' in request.POST and 'deploy' not in request.POST
+    return enqueue_deploy(request.user, selected_rule_groups, is_undeploy=is_undeploy)
+
+
+@login_required
+def deploy_status(request, job_id):
+    """Report the per host progress of a deployment job"""
+    job = get_object_or_404(DeployJob, id=job_id)
+    data = {
+        "id": job.id,
+        "status": job.get_status_display(),
+        "hosts": json.loads(job.progress),
+        "created": str(job.created),
+        "finished": str(job.finished) if job.finished else None,
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
 
 
 @login_required
 def panel(request):
     """Main Dashboard & Deployment operations"""
+    deploy_job = None
     if request.method == 'POST':
         add_rule_group = AddRuleGroupForm(request.POST)
         selected_rule_groups = request.POST.getlist('rule_group')
         if selected_rule_groups:
-            deploy(request, selected_rule_groups)
+            deploy_job = deploy(request, selected_rule_groups)
     else:
         add_rule_group = AddRuleGroupForm()
     regions = Region.objects.all()
     rule_group = RuleGroup.objects.all()
     add_region = AddRegionForm()
     actions_form = ActionsForm()
-    return render(request, "panel.html", {"add_region": add_region, "regions": regions,  "rule_group": rule_group, "add_rule_group": add_rule_group, "actions_form": actions_form})
+    return render(request, "panel.html", {"add_region": add_region, "regions": regions,  "rule_group": rule_group, "add_rule_group": add_rule_group, "actions_form": actions_form, "deploy_job": deploy_job})
 
 
 @login_required
@@ -309,23 +200,19 @@ def configure_hosts(request):
             selected_configurations = actions_form.cleaned_data
             selected_cidr = actions_form.cleaned_data["cidr"]
             if selected_cidr:
-                cidr = ipaddr.IPNetwork(selected_cidr)
-                for host in hosts:
-                    if cidr.overlaps(ipaddr.IPNetwork(host.ip_address)):
-                        host.region = selected_configurations["region"]
-                        host.instance_type = selected_configurations[
-                            "interface_type"]
-                        host.interface = selected_configurations["interface"]
-                        host.save()
+                first_key, last_key = ip_key_range(selected_cidr)
+                selected_hosts = Host.objects.filter(
+                    ip_key__gte=first_key, ip_key__lte=last_key)
             else:
-                selected_hosts = request.POST.getlist('hosts')
-                for host_id in selected_hosts:
-                    host = Host.objects.filter(id=host_id).update(region=selected_configurations["region"],
-                                                               instance_type=selected_configurations["instance_type"], interface=selected_configurations["interface"])
+                selected_hosts = Host.objects.filter(
+                    id__in=request.POST.getlist('hosts'))
+            selected_hosts.update(region=selected_configurations["region"],
+                                  instance_type=selected_configurations["instance_type"],
+                                  interface=selected_configurations["interface"])
+            invalidate_overview()
 
         hosts = Host.objects.all()
-        cmd = _update_topology_map(hosts)
-        _init_ansible(cmd, facts="no")
+        enqueue_topology_map_push()
 
     else:
         print(actions_form.errors)
@@ -333,28 +220,93 @@ def configure_hosts(request):
     return render(request, "configure_hosts.html", {"hosts": hosts, "hosts_form": hosts_form, "actions_form": actions_form})
 
 
+def _page_cursor(queryset, before):
+    """Returns the object that a keyset page continues after, 404 if `before` is not one of its ids"""
+    try:
+        before = int(before)
+    except ValueError:
+        raise Http404("Invalid page")
+    return get_object_or_404(queryset, id=before)
+
+
 @login_required
 def history(request):
-    """Show Audit logs"""
-    history = Audit.objects.all()
-    return render(request, "history.html", {"history": history})
+    """Show Audit logs, newest first, one page at a time
+
+    The pages are keyset paginated: `before` is the id of the last log of the
+    previous page and the next page continues right after its timestamp.
+    """
+    history = Audit.objects.order_by('-timestamp', '-id')
+    before = request.GET.get('before')
+    if before:
+        last = _page_cursor(Audit.objects.all(), before)
+        history = history.filter(Q(timestamp__lt=last.timestamp) | Q(
+            timestamp=last.timestamp, id__lt=last.id))
+    history = list(history[:HISTORY_PAGE_SIZE + 1])
+    next_page = history[HISTORY_PAGE_SIZE - 1].id if len(history) > HISTORY_PAGE_SIZE else None
+    return render(request, "history.html", {"history": history[:HISTORY_PAGE_SIZE], "next_page": next_page})
+
+
+class _Echo(object):
+    """A file-like object that returns what is written to it"""
+
+    def write(self, value):
+        return value
+
+
+@login_required
+def export_history(request):
+    """Stream all the Audit logs as CSV or, with ?format=ndjson, as JSON lines"""
+    logs = Audit.objects.order_by('timestamp', 'id').values_list(
+        'timestamp', 'user__username', 'status', 'log').iterator()
+    if request.GET.get('format') == 'ndjson':
+        rows = (json.dumps({"timestamp": str(timestamp), "user": user, "status": status, "log": log}) + "\n"
+                for timestamp, user, status, log in logs)
+        return StreamingHttpResponse(rows, content_type="application/x-ndjson")
+    writer = csv.writer(_Echo())
+    rows = itertools.chain(
+        [writer.writerow(["timestamp", "user", "status", "log"])],
+        (writer.writerow([str(timestamp), user or "", status, log])
+         for timestamp, user, status, log in logs))
+    response = StreamingHttpResponse(rows, content_type="text/csv")
+    response['Content-Disposition'] = 'attachment; filename="history.csv"'
+    return response
+
+
+def _page_query(request):
+    """Returns the query string of the request without the page number"""
+    params = request.GET.copy()
+    params.pop('page', None)
+    return params.urlencode()
+
+
+@login_required
+def list_json(request, listing):
+    """Return a page of hosts, rules, deployment groups or regions as JSON
+
+    Accepts the same `page`, `page_size`, `sort`, `q` and filter parameters
+    as the list views.
+    """
+    if listing not in LISTINGS:
+        return HttpResponse(status=404)
+    return HttpResponse(json.dumps(listing_values(listing, request.GET)), content_type="application/json")
 
 
 @login_required
 def list_deployment_groups(request):
     """List Deployment Groups"""
-    rule_group = RuleGroup.objects.all()
+    rule_group = paginate_listing('rule_groups', request.GET)
     add_rule_group = AddRuleGroupForm()
     actions_form = ActionsForm()
-    return render(request, "list_deployment_groups.html", {"add_rule_group": add_rule_group, "actions_form": actions_form, "rule_group": rule_group})
+    return render(request, "list_deployment_groups.html", {"add_rule_group": add_rule_group, "actions_form": actions_form, "rule_group": rule_group, "page": rule_group, "query": _page_query(request)})
 
 
 @login_required
 def list_all_hosts(request):
     """List All Available Hosts"""
-    hosts = Host.objects.all()
+    hosts = paginate_listing('hosts', request.GET)
     hosts_form = HostForm()
-    return render(request, "list_all_hosts.html", {"hosts_form": hosts_form, "hosts": hosts})
+    return render(request, "list_all_hosts.html", {"hosts_form": hosts_form, "hosts": hosts, "page": hosts, "query": _page_query(request)})
 
 
 @login_required
@@ -368,25 +320,24 @@ def list_region_hosts(request, region_name=None):
 @login_required
 def list_all_rules(request, rule_group_name=None):
     """List all Rules"""
-    rules = Rule.objects.all()
-    hosts = Host.objects.all()
-    hosts_form = HostForm()
     if rule_group_name:
-        rules = RuleGroup.objects.filter(name=rule_group_name)[0].rule.all()
+        rules = paginate_listing('rules', request.GET, rulegroup__name=rule_group_name)
+    else:
+        rules = paginate_listing('rules', request.GET)
     add_rule = AddRuleForm()
     actions_form = ActionsForm()
-    return render(request, "list_all_rules.html", {"actions_form": actions_form, "add_rule": add_rule, "rules": rules, "hosts_form": hosts_form, "hosts": hosts})
+    return render(request, "list_all_rules.html", {"actions_form": actions_form, "add_rule": add_rule, "rules": rules, "page": rules, "query": _page_query(request)})
 
 
 @login_required
 def list_host_rules(request, region_name=None, host_name=None):
     """List the Designated Rules of the Host"""
-    hosts = Host.objects.filter(name=host_name)
-    rules = Rule.objects.filter(host__name=host_name)
+    hosts = Host.objects.filter(name=host_name).select_related('region')
+    rules = paginate_listing('rules', request.GET, host__name=host_name)
     hosts_form = HostForm()
     add_rule = AddRuleForm()
     actions_form = ActionsForm()
-    return render(request, "list_host_rules.html", {"host_name": host_name, "actions_form": actions_form, "add_rule": add_rule, "rules": rules, "region_name": region_name, "hosts_form": hosts_form, "hosts": hosts})
+    return render(request, "list_host_rules.html", {"host_name": host_name, "actions_form": actions_form, "add_rule": add_rule, "rules": rules, "region_name": region_name, "hosts_form": hosts_form, "hosts": hosts, "page": rules, "query": _page_query(request)})
 
 
 @login_required
@@ -442,11 +393,9 @@ def add_region(request):
             print(add_region.errors)
     else:
         add_region = AddRegionForm()
-    regions = Region.objects.all()
-    hosts = Host.objects.all()
-    hosts_form = HostForm()
+    regions = paginate_listing('regions', request.GET)
     actions_form = ActionsForm()
-    return render(request, "add_region.html", {"hosts_form": hosts_form, "hosts": hosts, "add_region": add_region, "regions": regions, "actions_form": actions_form})
+    return render(request, "add_region.html", {"add_region": add_region, "regions": regions, "actions_form": actions_form, "page": regions, "query": _page_query(request)})
 
 
 @login_required
@@ -484,9 +433,9 @@ def add_rule(request):
     else:
         add_rule = AddRuleForm()
     actions_form = ActionsForm()
-    rules = Rule.objects.all()
+    rules = paginate_listing('rules', request.GET)
     return render(request, "add_rule.html",
-                  {"add_rule": add_rule, "rules": rules, "actions_form": actions_form})
+                  {"add_rule": add_rule, "rules": rules, "actions_form": actions_form, "page": rules, "query": _page_query(request)})
 
 
 @login_required
@@ -499,28 +448,10 @@ def add_rule_group(request):
             rule_group = add_rule_group.save()
             selected_hosts = request.POST.getlist('hosts')
             if selected_hosts:
-                for src_host in selected_hosts:
-                    for dst_host in selected_hosts:
-                        if src_host != dst_host:
-                            rule = Rule()
-                            rule.host = Host.objects.get(id=src_host)
-                            rule.target_host = Host.objects.get(id=dst_host)
-                            rule.target_region = rule.target_host.region
-                            if rule.host.instance_type:
-                                rule.bandwidth = rule.host.instance_type.bandwidth
-                                rule.latency = rule.host.instance_type.latency
-                                rule.interface = rule.host.interface
-                                rule.bw_rate = rule.host.instance_type.bw_rate
-                                rule.packet_loss = rule.host.instance_type.packet_loss
-                                rule.packet_corruption_rate = rule.host.instance_type.packet_corruption_rate
-                                rule.latency_time_unit = rule.host.instance_type.latency_time_unit
-                            rule.save()
-                            rule_group.rule.add(rule)
+                build_full_mesh(rule_group, selected_hosts)
             selected_rules = request.POST.getlist('rules')
             if selected_rules:
-                for rule_id in selected_rules:
-                    rule = Rule.objects.get(id=rule_id)
-                    rule_group.rule.add(rule)
+                rule_group.rule.add(*selected_rules)
             rule_group.save()
             _log_action(rule_group.name, attrs={
                         'type': 'rule group', 'action': 'create'})
@@ -608,35 +539,15 @@ def delete_wan(request):
 
 @login_required
 def delete_rule(request):
-    """Delete rules view"""
+    """Delete rules view, the shaping of their hosts is reapplied in the background"""
     if request.method == 'POST':
         actions = ActionsForm(request.POST)
         if actions.is_valid():
             rules = request.POST.getlist('rules')
+            enqueue_rule_deletion(request.user, rules)
             for rule_id in rules:
-                rule = Rule.objects.get(id=rule_id)
-                inventory = AnsibleInventory()
-                hosts = inventory.unique_hosts_data
-                global_options = inventory.global_options
-                host_options = inventory.DEFAULT_OPTIONS.copy()
-                host_options.update(global_options[0])
-                host_vars = [host["vars"]
-                             for host in hosts if host["name"] == rule.host.name]
-                host_options.update(host_vars[0])
-
-                command = generate_tc_command(rule, deactivate=True)
                 _log_action(rule_id, attrs={
                             'type': 'rule', 'action': 'delete'})
-                status = AnsibleDeploy(options=host_options).deploy(
-                    command, rule.host.name, facts='no')
-                rule.delete()
-                all_host_rules = Rule.objects.filter(host__name=rule.host.name)
-                for host_rule in all_host_rules:
-                    deploy_the_rest_of_the_rules = generate_tc_command(
-                        host_rule, deactivate=True)
-                    # TODO:  log
-                    status = AnsibleDeploy(options=host_options).deploy(
-                        deploy_the_rest_of_the_rules, host_rule.host.name, facts='no')
         else:
             print(actions.errors)
     return HttpResponseRedirect('/rule/add')
@@ -693,10 +604,8 @@ def logout(request):
 
 def _log_action(entity, attrs):
     """Audit events view"""
-    timestamp = str(datetime.datetime.now())
     if attrs['action'] == 'delete':
         log = "Deleted {0}".format(attrs['type'].capitalize())
     elif attrs['action'] == 'create':
         log = "Created {0}".format(entity)
-    log_command = Audit(timestamp=timestamp, log=log)
-    log_command.save()
+    audit_sink.log(log)
@@ -51,6 +51,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'control_panel.audit.AuditFlushMiddleware',
 ]
 
 ROOT_URLCONF = 'tc-panel.urls'
@@ -84,6 +85,15 @@ DATABASES = {
     }
 }
 
+# The cache is shared by the web and the worker processes, create its table with
+# `python manage.py createcachetable`
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'tc_panel_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -140,6 +150,69 @@ REST_FRAMEWORK = {
 
 ANSIBLE_INVENTORY = "/path/to/hosts"
 
+# How the shaping is applied to the hosts: "commands" runs a tcset/tcdel per
+# changed filter, "import" applies one tcconfig setting per host at once
+TC_DEPLOY_MODE = "commands"
+
+# Collapse the destination hosts that share the same shaping into the
+# smallest set of CIDR blocks, one filter per block instead of one per host
+TC_AGGREGATE_NETWORKS = False
+
+# Deployment queue: "thread" runs the jobs in a local worker pool, "database"
+# leaves them pending for `manage.py run_deploy_worker`. Jobs that change the
+# shaping of hosts run one at a time whatever the number of workers and
+# processes, they hold a lock in the database that is taken over once it was
+# not refreshed for SHAPING_LOCK_TIMEOUT seconds
+DEPLOY_QUEUE_BACKEND = "thread"
+DEPLOY_WORKERS = 1
+SHAPING_LOCK_TIMEOUT = 600
+
+# Minimum seconds between two writes of the progress of a running deploy job
+DEPLOY_PROGRESS_INTERVAL = 1
+
+# Hosts that receive the Hadoop topology map when it changes: "all" or
+# "changed" for only the hosts whose region changed
+TOPOLOGY_MAP_PUSH = "all"
+
+# Reuse one SSH connection per host across plays (ControlMaster sockets kept
+# for ANSIBLE_SSH_CONTROL_PERSIST seconds) and enable pipelining. Pipelining
+# requires `requiretty` to be disabled in the sudoers file of the hosts
+ANSIBLE_SSH_PERSIST = False
+ANSIBLE_SSH_CONTROL_PERSIST = 600
+ANSIBLE_SSH_CONTROL_PATH_DIR = os.path.join(BASE_DIR, 'ssh_control')
+
+# Snapshots of the live shaping of the hosts (tcshow) are trusted for
+# SHAPING_SNAPSHOT_TTL seconds, deploys skip the hosts that they show up to date
+SHAPING_SNAPSHOT_TTL = 300
+
+# The bird's eye graph is cached for at most OVERVIEW_CACHE_TTL seconds, changes
+# to the rules, hosts, regions and WANs drop it right away
+OVERVIEW_CACHE_TTL = 300
+
+# Rows per page of the host, rule, deployment group and region tables
+LIST_PAGE_SIZE = 100
+
+# Audit logs are buffered and written in bulk once the buffer holds
+# AUDIT_BUFFER_SIZE logs, the oldest one is AUDIT_BUFFER_AGE seconds old, or
+# the request or background job ends
+AUDIT_BUFFER_SIZE = 100
+AUDIT_BUFFER_AGE = 5
+
+# A deploy job sends one summary notification per recipient that lists up to
+# NOTIFICATION_HOSTS failed hosts with NOTIFICATION_EXCERPT characters of their
+# error output each
+NOTIFICATION_HOSTS = 20
+NOTIFICATION_EXCERPT = 200
+
+# Hourly fact gathering: no new batch of hosts starts after the time budget
+# and every host gets the timeout (both in seconds)
+GATHER_TIME_BUDGET = 3000
+GATHER_HOST_TIMEOUT = 30
+
+# Gathered facts are cached per host and reused for FACT_CACHE_TTL seconds
+FACT_CACHE_DIR = os.path.join(BASE_DIR, 'fact_cache')
+FACT_CACHE_TTL = 21600
+
 try:
     from local_settings import *
 except ImportError:
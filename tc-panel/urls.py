@@ -10,10 +10,14 @@ urlpatterns = [
     url(r'panel/(?P<host_name>[\w.]+)/$', views.list_host_rules, name='list_host_rules'),
     url(r'panel/hosts/all/$', views.list_all_hosts, name='list_all_hosts'),
     url(r'^panel$', views.panel, name='panel'),
+    url(r'^deploy/(?P<job_id>\d+)/status/$', views.deploy_status, name='deploy_status'),
+    url(r'^verify/host/(?P<host_name>[\w.-]+)/$', views.verify_host, name='verify_host'),
+    url(r'^verify/rule_group/(?P<rule_group_name>[\w+-]+)/$', views.verify_rule_group, name='verify_rule_group'),
     url(r'^register/$', views.register, name='register'),
     url(r'^login/$', views.login, name='login'),
     url(r'^logout/$', views.logout, name='logout'),
     url(r'^rule/list/all/$', views.list_all_rules, name='list_all_rules'),
+    url(r'^api/(?P<listing>hosts|rules|rule_groups|regions)/$', views.list_json, name='list_json'),
     url(r'^rule/add/$', views.add_rule, name='add_rule'),
     url(r'^rule/delete/$', views.delete_rule, name='delete_rule'),
     url(r'^region/add/$', views.add_region, name='add_region'),
@@ -31,6 +35,7 @@ urlpatterns = [
     url(r'^messages/$', views.view_notifications, name='view_notifications'),
     url(r'^dismiss_message/$', views.dismiss_message, name='dismiss_message'),
     url(r'^history/$', views.history, name='history'),
+    url(r'^history/export/$', views.export_history, name='export_history'),
     url(r'^groups/$', views.groups, name='groups'),
     url(r'^overview/$', views.overview, name='overview'),
 ]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tc-panel.settings")
 
 application = get_wsgi_application()
+
+# The jobs of the "thread" deployment queue run in the web process, fail the
+# ones that the previous process left running and run the pending ones
+from control_panel.tasks import start_deploy_queue
+start_deploy_queue()